@@ -0,0 +1,263 @@
+"""time each pycashier step on synthetic data at several scales
+
+Usage:
+    python -m benchmarks.run --scales 10000 100000 --threads 4
+
+Results are written as json to `benchmarks/results/` so runs can be compared over time.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+from datetime import datetime, timezone
+from importlib.metadata import version
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Sequence
+
+import click
+
+from pycashier.cli import extract, merge, receipt, scrna
+from pycashier.merge import get_pefastqs
+from pycashier.metrics import StepUsage, peak_rss
+from pycashier.options import PycashierOpts
+from pycashier.receipt import receipt as combine
+from pycashier.sample import (
+    ExtractSample,
+    MergeSample,
+    Sample,
+    SampleStatus,
+    ScrnaSample,
+)
+from pycashier.term import term
+
+from .synthetic import Library, write_fastq, write_paired_fastqs, write_sam
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+# extract configurations to compare
+EXTRACT_VARIANTS: Dict[str, List[str]] = {
+    "extract": [],
+    "extract-stream": ["--stream"],
+    "extract-native": ["--extract-engine", "native", "--cluster-engine", "native"],
+}
+BENCHMARKS = (*EXTRACT_VARIANTS, "merge", "scrna", "receipt")
+
+Result = Dict[str, Any]
+
+
+def make_opts(cmd: click.Command, args: Sequence[str]) -> PycashierOpts:
+    """parse command line arguments the same way the cli does"""
+    ctx = cmd.make_context(str(cmd.name), list(args))
+    ctx.params.pop("save_config", None)
+    opts = PycashierOpts(**ctx.params)
+    if cmd is extract:
+        opts.update_filter(ctx)
+    opts.pipeline.mkdir(parents=True, exist_ok=True)
+    opts.output.parent.mkdir(parents=True, exist_ok=True)
+    term.set_logger(opts.log_file, opts.verbose)
+    return opts
+
+
+def time_steps(sample: Sample) -> List[Result]:
+    """run each step of a sample and record its wall time, cpu time and memory"""
+    results = []
+    for step in sample.steps:
+        with StepUsage(step.__name__.lstrip("_")) as usage:
+            step()
+        results.append(
+            {
+                "step": usage.step,
+                "seconds": usage.wall,
+                "cpu_seconds": usage.user + usage.sys,
+                "max_rss": usage.max_rss,
+                "failed": sample.status is SampleStatus.FAIL,
+            }
+        )
+        if sample.status is SampleStatus.FAIL:
+            break
+    return results
+
+
+def bench_extract(
+    workdir: Path,
+    library: Library,
+    reads: int,
+    args: argparse.Namespace,
+    extra: List[str],
+) -> List[Result]:
+    fastqs = workdir / "fastqs"
+    if not fastqs.is_dir():
+        fastqs.mkdir()
+        write_fastq(
+            fastqs / "synthetic.fastq.gz", library, reads, error_rate=args.error_rate
+        )
+    pipeline = workdir / f"pipeline-{'-'.join(extra) or 'default'}"
+    shutil.rmtree(pipeline, ignore_errors=True)
+    opts = make_opts(
+        extract,
+        ["-i", str(fastqs), "-p", str(pipeline), "-o", str(workdir / "outs")]
+        + ["-t", str(args.threads), "-y", *extra],
+    )
+    opts.output.mkdir(exist_ok=True)
+    return time_steps(ExtractSample(fastqs / "synthetic.fastq.gz", opts))
+
+
+def bench_merge(
+    workdir: Path, library: Library, reads: int, args: argparse.Namespace
+) -> List[Result]:
+    fastqs = workdir / "unmerged"
+    fastqs.mkdir()
+    write_paired_fastqs(
+        fastqs / "synthetic.R1.fastq.gz",
+        fastqs / "synthetic.R2.fastq.gz",
+        library,
+        reads,
+        error_rate=args.error_rate,
+    )
+    opts = make_opts(
+        merge,
+        ["-i", str(fastqs), "-p", str(workdir / "pipeline-merge")]
+        + ["-o", str(workdir / "merged"), "-t", str(args.threads), "-y"],
+    )
+    (opts.pipeline / "merge_qc").mkdir(exist_ok=True)
+    opts.output.mkdir(exist_ok=True)
+    pair = get_pefastqs(sorted(fastqs.iterdir()))["synthetic"]
+    return time_steps(MergeSample(pair["R1"], pair["R2"], opts))
+
+
+def bench_scrna(
+    workdir: Path, library: Library, reads: int, args: argparse.Namespace
+) -> List[Result]:
+    sams = workdir / "sams"
+    sams.mkdir()
+    write_sam(sams / "synthetic.sam", library, reads, error_rate=args.error_rate)
+    opts = make_opts(
+        scrna,
+        ["-i", str(sams), "-p", str(workdir / "pipeline-scrna")]
+        + ["-o", str(workdir / "outs-scrna"), "-t", str(args.threads), "-y"],
+    )
+    opts.output.mkdir(exist_ok=True)
+    return time_steps(ScrnaSample(sams / "synthetic.sam", opts))
+
+
+def bench_receipt(
+    workdir: Path, library: Library, reads: int, args: argparse.Namespace
+) -> List[Result]:
+    outs = workdir / "outs"
+    if not any(outs.glob("*.tsv")):
+        bench_extract(workdir, library, reads, args, [])
+    # several samples sharing the same lineages exercise the overlap calculation
+    tsv = next(outs.glob("*.tsv"))
+    samples = workdir / "outs-receipt"
+    samples.mkdir()
+    for i in range(args.receipt_samples):
+        shutil.copy(tsv, samples / f"sample{i}.{tsv.name.split('.', 1)[1]}")
+    opts = make_opts(
+        receipt,
+        ["-i", str(samples), "-o", str(workdir / "combined.tsv")]
+        + ["-p", str(workdir / "pipeline-receipt")],
+    )
+    with StepUsage("receipt") as usage:
+        combine({f.name.split(".")[0]: f for f in sorted(samples.iterdir())}, opts)
+    return [
+        {
+            "step": usage.step,
+            "seconds": usage.wall,
+            "cpu_seconds": usage.user + usage.sys,
+            "max_rss": usage.max_rss,
+            "failed": False,
+        }
+    ]
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    runners: Dict[str, Callable[..., List[Result]]] = {
+        "merge": bench_merge,
+        "scrna": bench_scrna,
+        "receipt": bench_receipt,
+    }
+    results = []
+    for reads in args.scales:
+        workdir = Path(tempfile.mkdtemp(prefix=f"pycashier-bench-{reads}-"))
+        library = Library(args.lineages, exponent=args.exponent, seed=args.seed)
+        try:
+            for name in args.benchmarks:
+                term.print(f"[hl]{name}[/]: {reads} reads")
+                if name in EXTRACT_VARIANTS:
+                    steps = bench_extract(
+                        workdir, library, reads, args, EXTRACT_VARIANTS[name]
+                    )
+                else:
+                    steps = runners[name](workdir, library, reads, args)
+                for step in steps:
+                    step.update(
+                        benchmark=name,
+                        reads=reads,
+                        reads_per_second=reads / max(step["seconds"], 1e-9),
+                    )
+                    term.print(f"  {step['step']}: {step['seconds']:.2f}s")
+                results.extend(steps)
+        finally:
+            if args.keep:
+                term.print(f"kept benchmark data in [hl]{workdir}")
+            else:
+                shutil.rmtree(workdir)
+
+    return {
+        "pycashier": version("pycashier"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "keep")},
+        "results": results,
+        "max_rss": peak_rss(),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--scales",
+        type=int,
+        nargs="+",
+        default=[10_000, 100_000, 1_000_000],
+        help="number of reads to generate for each run",
+    )
+    parser.add_argument("--lineages", type=int, default=1_000)
+    parser.add_argument(
+        "--exponent", type=float, default=1.0, help="power-law exponent of abundance"
+    )
+    parser.add_argument("--error-rate", type=float, default=0.005)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument(
+        "--receipt-samples", type=int, default=10, help="samples combined by receipt"
+    )
+    parser.add_argument(
+        "--benchmarks", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS)
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        help=f"json file to write results to [default: {RESULTS_DIR}/<date>.json]",
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="keep generated data and outputs"
+    )
+    args = parser.parse_args()
+
+    results = run(args)
+    output = args.output or RESULTS_DIR / f"{results['date'].replace(':', '')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2) + "\n")
+    term.print(f"results written to [hl]{output}")
+
+
+if __name__ == "__main__":
+    main()
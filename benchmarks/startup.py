@@ -0,0 +1,74 @@
+"""time pycashier's startup, failing if it exceeds a budget
+
+Usage:
+    python -m benchmarks.startup --runs 10 --budget 0.5
+"""
+
+from __future__ import annotations
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from typing import List, Sequence
+
+# modules only needed once a command runs, they must not be imported at startup
+HEAVY_MODULES = ("polars", "pysam", "tomlkit", "rich.traceback")
+
+CLI = [sys.executable, "-c", "from pycashier.cli import main; main()"]
+COMMANDS = {
+    "import": [sys.executable, "-c", "import pycashier.cli"],
+    "help": [*CLI, "--help"],
+    "extract-help": [*CLI, "extract", "--help"],
+}
+
+
+def time_command(cmd: Sequence[str], runs: int) -> float:
+    """median wall time of running a command"""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def imported_heavy_modules() -> List[str]:
+    """heavy modules imported along with the cli"""
+    p = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, pycashier.cli; "
+            f"print(*(m for m in {HEAVY_MODULES!r} if m in sys.modules))",
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return p.stdout.split()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "--budget", type=float, default=0.5, help="maximum median seconds per command"
+    )
+    args = parser.parse_args()
+
+    failed = False
+    if heavy := imported_heavy_modules():
+        print(f"imported at startup: {', '.join(heavy)}")
+        failed = True
+    for name, cmd in COMMANDS.items():
+        seconds = time_command(cmd, args.runs)
+        over = seconds > args.budget
+        print(f"{name}: {seconds:.3f}s{' (over budget)' if over else ''}")
+        failed |= over
+    sys.exit(failed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""deterministic synthetic lineage barcode data"""
+
+from __future__ import annotations
+
+import gzip
+import random
+from itertools import accumulate
+from pathlib import Path
+from typing import IO, Iterator, List, Tuple
+
+from pycashier.options import optmap
+
+UPSTREAM = optmap.get("upstream-adapter")
+DOWNSTREAM = optmap.get("downstream-adapter")
+BASES = "ACGT"
+COMPLEMENT = str.maketrans("ACGT", "TGCA")
+
+# phred+33 quality of correct and erroneous bases
+HIGH_QUALITY, LOW_QUALITY = "F", ","
+
+
+class Library:
+    """a population of lineages with power-law distributed abundance
+
+    Args:
+        lineages: Number of distinct lineage barcodes.
+        length: Length of each barcode.
+        exponent: Power-law exponent, the i-th lineage has weight i^-exponent.
+        seed: Random seed, the same seed always yields the same library and reads.
+    """
+
+    def __init__(
+        self, lineages: int, length: int = 20, exponent: float = 1.0, seed: int = 0
+    ) -> None:
+        self.rng = random.Random(seed)
+        self.length = length
+        barcodes = set()
+        while len(barcodes) < lineages:
+            barcodes.add("".join(self.rng.choices(BASES, k=length)))
+        self.barcodes = sorted(barcodes)
+        self.rng.shuffle(self.barcodes)
+        self._cum_weights = list(
+            accumulate((i + 1) ** -exponent for i in range(lineages))
+        )
+
+    def sample(self, n: int) -> List[str]:
+        """draw n barcodes according to their abundance"""
+        return self.rng.choices(self.barcodes, cum_weights=self._cum_weights, k=n)
+
+    def random(self, n: int) -> str:
+        return "".join(self.rng.choices(BASES, k=n))
+
+    def mutate(self, seq: str, error_rate: float) -> Tuple[str, str]:
+        """introduce substitutions and small indels at `error_rate` per base
+
+        Returns:
+            Sequence and matching quality string.
+        """
+        bases, quals = [], []
+        for base in seq:
+            if self.rng.random() >= error_rate:
+                bases.append(base)
+                quals.append(HIGH_QUALITY)
+                continue
+            kind = self.rng.random()
+            if kind < 0.8:
+                bases.append(self.rng.choice(BASES.replace(base, "")))
+                quals.append(LOW_QUALITY)
+            elif kind < 0.9:
+                # deletion
+                continue
+            else:
+                bases.extend((base, self.rng.choice(BASES)))
+                quals.extend((HIGH_QUALITY, LOW_QUALITY))
+        return "".join(bases), "".join(quals)
+
+    def fragments(
+        self,
+        n: int,
+        upstream: str = UPSTREAM,
+        downstream: str = DOWNSTREAM,
+        flank: int = 20,
+    ) -> Iterator[Tuple[str, str]]:
+        """amplicons of random flank, upstream adapter, barcode, downstream adapter
+
+        Yields:
+            Barcode and amplicon sequence.
+        """
+        for barcode in self.sample(n):
+            prefix = self.random(self.rng.randint(0, flank))
+            yield (
+                barcode,
+                prefix + upstream + barcode + downstream + self.random(flank),
+            )
+
+
+def revcomp(seq: str) -> str:
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def _open(path: Path) -> IO[str]:
+    return gzip.open(path, "wt") if path.name.endswith(".gz") else path.open("w")  # type: ignore
+
+
+def write_fastq(
+    path: Path,
+    library: Library,
+    reads: int,
+    error_rate: float = 0.005,
+    read_length: int = 75,
+    **layout: str,
+) -> None:
+    """write single-end reads of the library's amplicons
+
+    Reads are truncated to `read_length`, so the downstream adapter
+    is often only partially sequenced like in real data.
+
+    Args:
+        path: Fastq to write, gzipped if it ends with .gz.
+        library: Lineages to sample reads from.
+        reads: Number of reads.
+        error_rate: Per base sequencing error rate.
+        read_length: Maximum read length.
+        **layout: Upstream/downstream adapters passed to `Library.fragments`.
+    """
+    with _open(path) as f:
+        for i, (_, fragment) in enumerate(library.fragments(reads, **layout)):
+            seq, qual = library.mutate(fragment[:read_length], error_rate)
+            f.write(f"@read{i}\n{seq}\n+\n{qual}\n")
+
+
+def write_paired_fastqs(
+    r1: Path,
+    r2: Path,
+    library: Library,
+    reads: int,
+    error_rate: float = 0.005,
+    read_length: int = 75,
+    **layout: str,
+) -> None:
+    """write overlapping paired-end reads of the library's amplicons
+
+    Args:
+        r1: Forward reads fastq.
+        r2: Reverse reads fastq.
+        library: Lineages to sample reads from.
+        reads: Number of read pairs.
+        error_rate: Per base sequencing error rate.
+        read_length: Length of each mate.
+        **layout: Upstream/downstream adapters passed to `Library.fragments`.
+    """
+    with _open(r1) as f1, _open(r2) as f2:
+        for i, (_, fragment) in enumerate(library.fragments(reads, **layout)):
+            for f, mate, read in ((f1, fragment, "1"), (f2, revcomp(fragment), "2")):
+                seq, qual = library.mutate(mate[:read_length], error_rate)
+                f.write(f"@read{i} {read}:N:0\n{seq}\n+\n{qual}\n")
+
+
+def write_sam(
+    path: Path,
+    library: Library,
+    reads: int,
+    cells: int = 100,
+    error_rate: float = 0.005,
+    read_length: int = 90,
+    **layout: str,
+) -> None:
+    """write unmapped 10X style records tagged with cell barcodes and UMIs
+
+    Args:
+        path: Sam file to write.
+        library: Lineages to sample reads from.
+        reads: Number of records.
+        cells: Number of distinct cell barcodes.
+        error_rate: Per base sequencing error rate.
+        read_length: Maximum read length.
+        **layout: Upstream/downstream adapters passed to `Library.fragments`.
+    """
+    cell_barcodes = [library.random(16) for _ in range(cells)]
+    with path.open("w") as f:
+        f.write("@HD\tVN:1.6\tSO:unsorted\n")
+        for i, (_, fragment) in enumerate(library.fragments(reads, **layout)):
+            seq, qual = library.mutate(fragment[:read_length], error_rate)
+            cell = library.rng.choice(cell_barcodes)
+            umi = library.random(12)
+            f.write(
+                f"read{i}\t4\t*\t0\t0\t*\t*\t0\t0\t{seq}\t{qual}\t"
+                f"CR:Z:{cell}\tCB:Z:{cell}-1\tUR:Z:{umi}\tUB:Z:{umi}\n"
+            )
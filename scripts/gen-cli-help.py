@@ -60,7 +60,10 @@ def generate_rst(command=""):
 def main():
     cli_docs = "\n".join(
         ["=============", "CLI Reference", "=============", generate_rst()]
-        + [generate_rst(cmd) for cmd in ["extract", "merge", "receipt", "scrna"]]
+        + [
+            generate_rst(cmd)
+            for cmd in ["extract", "merge", "receipt", "scrna", "status"]
+        ]
     )
     (ROOT / "docs/cli.rst").write_text(cli_docs)
 
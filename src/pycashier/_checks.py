@@ -16,6 +16,7 @@ PACKAGES = {"cutadapt": cutadapt, "fastp": fastp, "starcode": starcode, "pysam":
 CMD_PACKAGES: Dict[str, List[str]] = {
     "": sorted(PACKAGES),
     "receipt": [],
+    "status": [],
     "merge": ["fastp"],
     "extract": ["fastp", "cutadapt", "starcode"],
     "scrna": ["pysam", "cutadapt"],
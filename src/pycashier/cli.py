@@ -1,16 +1,28 @@
 import shutil
-from typing import Any, Callable, Dict, List
+import sys
+from types import TracebackType
+from typing import Any, Callable, Dict, List, Optional, Type
 
 import click
 from click_rich_help import StyledGroup
-from rich.traceback import install
 
 from ._checks import pre_run_check
 from .options import Option, optmap
 from .pycashier import Pycashier
 from .term import theme
 
-install(suppress=[click], show_locals=True)
+
+def excepthook(
+    exc_type: Type[BaseException], exc: BaseException, tb: Optional[TracebackType]
+) -> None:
+    """install rich's traceback handler only once an uncaught exception occurs"""
+    from rich.traceback import install
+
+    install(suppress=[click], show_locals=True)
+    sys.excepthook(exc_type, exc, tb)
+
+
+sys.excepthook = excepthook
 
 
 def add_options(
@@ -102,6 +114,25 @@ def extract(ctx: click.Context, save_config: bool, **kwargs: Any) -> None:
     pycashier.extract(ctx, **kwargs)
 
 
+@cli.command(
+    option_groups=get_help_groups(
+        optmap.subcmds["extract"],
+        extra_groups=[
+            "Quality (Fastp) Options",
+            "Trim (Cutadapt) Options",
+            "Cluster (Starcode) Options",
+            "Filter Options",
+        ],
+    ),
+    help=Pycashier.status.__doc__,
+)
+@add_options([option.get_click_option() for option in optmap.subcmds["extract"]])
+@click.pass_context
+def status(ctx: click.Context, save_config: bool, **kwargs: Any) -> None:
+    pycashier = Pycashier(ctx, save_config, **kwargs)
+    pycashier.status(ctx)
+
+
 @cli.command(
     option_groups=get_help_groups(
         optmap.subcmds["merge"], extra_groups=["Merge Options"]
@@ -120,6 +151,7 @@ def merge(ctx: click.Context, save_config: bool, **kwargs: Any) -> None:
         optmap.subcmds["scrna"],
         extra_groups=[
             "Trim (Cutadapt) Options",
+            "Cluster (Starcode) Options",
         ],
     ),
     help=Pycashier.scrna.__doc__,
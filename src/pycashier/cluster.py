@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Dict, List, Sequence
+
+import polars as pl
+
+from .term import term
+
+# largest distance supported by the deletion neighborhood index
+MAX_DISTANCE = 2
+
+
+def levenshtein(a: str, b: str, max_distance: int) -> int:
+    """edit distance between two sequences, capped at max_distance + 1
+
+    Only the diagonal band of width `max_distance` is computed.
+
+    Args:
+        a: First sequence.
+        b: Second sequence.
+        max_distance: Largest distance of interest.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    over = max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [over] * len(b)
+        for j in range(max(1, i - max_distance), min(len(b), i + max_distance) + 1):
+            current[j] = min(
+                previous[j - 1] + (a[i - 1] != b[j - 1]),
+                previous[j] + 1,
+                current[j - 1] + 1,
+            )
+        if min(current) > max_distance:
+            return over
+        previous = current
+    return min(previous[-1], over)
+
+
+def _deletion_neighborhood(df: pl.DataFrame, distance: int) -> pl.DataFrame:
+    """all sequences reachable from each barcode by up to `distance` deletions
+
+    Two barcodes within a levenshtein distance of d share
+    at least one sequence in their d-deletion neighborhoods.
+
+    Args:
+        df: Unique barcodes with an integer "id" column.
+        distance: Maximum number of deletions.
+    Returns:
+        Dataframe of "id" and "variant".
+    """
+    variants = df.select("id", variant=pl.col("barcode"))
+    for _ in range(distance):
+        max_length: int = (
+            variants.select(pl.col("variant").str.len_chars().max()).item() or 0
+        )
+        variants = (
+            variants.select(
+                "id",
+                variant=pl.concat_list(
+                    pl.col("variant"),
+                    *(
+                        pl.concat_str(
+                            pl.col("variant").str.slice(0, i),
+                            pl.col("variant").str.slice(i + 1),
+                        )
+                        for i in range(max_length)
+                    ),
+                ),
+            )
+            .explode("variant")
+            .unique()
+        )
+    return variants
+
+
+def find_parents(
+    df: pl.DataFrame, distance: int, ratio: float, by: Sequence[str] = ()
+) -> pl.DataFrame:
+    """pairs of barcodes within `distance` where one may absorb the other
+
+    A barcode is the parent of another if its count
+    is at least `ratio` times greater.
+
+    Args:
+        df: Unique barcodes with "id", "barcode" and "count" columns.
+        distance: Maximum levenshtein distance.
+        ratio: Minimum ratio of parent to child counts.
+        by: Columns that must match between parent and child, i.e. the cell.
+    Returns:
+        Dataframe of "child", "parent" and "distance".
+    """
+    variants = _deletion_neighborhood(df.select("id", "barcode"), distance)
+    if by:
+        variants = variants.join(df.select("id", *by), on="id")
+    counts = df.select("id", "barcode", "count")
+    candidates = (
+        variants.join(variants, on=["variant", *by], suffix="_other")
+        .filter(pl.col("id") != pl.col("id_other"))
+        .select(child="id", parent="id_other")
+        .unique()
+        .join(counts, left_on="child", right_on="id")
+        .join(counts, left_on="parent", right_on="id", suffix="_parent")
+        .filter(pl.col("count_parent") >= ratio * pl.col("count"))
+    )
+    return candidates.with_columns(
+        distance=pl.Series(
+            [
+                levenshtein(child, parent, distance)
+                for child, parent in candidates.select(
+                    "barcode", "barcode_parent"
+                ).iter_rows()
+            ],
+            dtype=pl.Int64,
+        )
+    ).filter(pl.col("distance") <= distance)
+
+
+def message_passing(df: pl.DataFrame, parents: pl.DataFrame) -> Dict[int, int]:
+    """assign each barcode to the canonical barcode of its cluster
+
+    Like starcode, each barcode is claimed by its parents at the lowest
+    distance. Barcodes are resolved from most to least abundant,
+    those whose parents belong to different clusters are ambiguous
+    and left unassigned.
+
+    Args:
+        df: Unique barcodes with "id", "barcode" and "count" columns.
+        parents: Output of `find_parents`.
+    Returns:
+        Mapping of barcode id to canonical barcode id.
+    """
+    nearest = (
+        parents.filter(pl.col("distance") == pl.col("distance").min().over("child"))
+        .group_by("child")
+        .agg("parent")
+    )
+    closest: Dict[int, List[int]] = dict(
+        zip(
+            nearest.get_column("child").to_list(),
+            nearest.get_column("parent").to_list(),
+        )
+    )
+    canonical: Dict[int, int] = {}
+    for id_ in df.sort(["count", "barcode"], descending=[True, False]).get_column("id"):
+        if id_ not in closest:
+            canonical[id_] = id_
+            continue
+        clusters = {canonical.get(parent) for parent in closest[id_]}
+        if len(clusters) == 1 and (cluster := clusters.pop()) is not None:
+            canonical[id_] = cluster
+    return canonical
+
+
+def cluster_barcodes(
+    in_file: Path, out_file: Path, distance: int, ratio: float
+) -> bool | None:
+    """cluster barcode counts in-process with message passing
+
+    Args:
+        in_file: TSV of unique barcodes and their counts.
+        out_file: TSV to write clustered barcodes and counts to.
+        distance: Maximum levenshtein distance, at most 2.
+        ratio: Minimum ratio of parent to child counts.
+    """
+    df = pl.read_csv(
+        in_file,
+        separator="\t",
+        has_header=False,
+        new_columns=["barcode", "count"],
+        schema_overrides={"barcode": pl.String, "count": pl.Int64},
+    ).with_row_index("id")
+
+    if df.height == 0:
+        term.log.error(f"failed to cluster barcodes for: {in_file}\nno barcodes found")
+        return True
+
+    parents = find_parents(df, distance, ratio)
+    canonical = message_passing(df, parents)
+    term.log.debug(
+        f"clustered {df.height} unique barcodes into "
+        f"{len(set(canonical.values()))} clusters, "
+        f"{df.height - len(canonical)} ambiguous"
+    )
+
+    clusters = df.join(
+        pl.DataFrame(
+            {"id": list(canonical), "canonical": list(canonical.values())},
+            schema={"id": pl.UInt32, "canonical": pl.UInt32},
+        ),
+        on="id",
+    )
+    result = (
+        clusters.group_by("canonical")
+        .agg(pl.col("count").sum())
+        .join(df.select("id", "barcode"), left_on="canonical", right_on="id")
+        .select("barcode", "count")
+        .sort(["count", "barcode"], descending=[True, False])
+    )
+
+    result.write_csv(out_file, separator="\t", include_header=False)
@@ -1,11 +1,13 @@
 from pathlib import Path
 
 import click
-import tomlkit
 
 from ._checks import check_file_permissions
 from .term import term
 
+# parameters whose names avoid shadowing builtins, saved under their readable names
+SHADOWED_PARAMS = {"input_": "input", "format_": "format"}
+
 
 def save_params(ctx: click.Context) -> None:
     """save parameters to config file
@@ -13,6 +15,8 @@ def save_params(ctx: click.Context) -> None:
     Args:
         ctx: Click context.
     """
+    import tomlkit
+
     cmd = ctx.info_name
     all_params = {k: v for k, v in ctx.params.items() if v}
     save_type = all_params.pop("save_config")
@@ -46,12 +50,13 @@ def save_params(ctx: click.Context) -> None:
     else:
         params = all_params.copy()
 
-    # use readable name for input
-    if "input_" in params:
-        params["input"] = params.pop("input_")
+    # use readable name for input/format
+    for name, readable in SHADOWED_PARAMS.items():
+        if name in params:
+            params[readable] = params.pop(name)
 
     # sanitize the path's for writing to toml
-    for k in ["input", "pipeline", "output"]:
+    for k in ["input", "pipeline", "output", "whitelist"]:
         if k in params.keys():
             params[k] = str(params[k])
 
@@ -88,6 +93,8 @@ def load_params(ctx: click.Context, param: str, filename: Path) -> None:
     check_file_permissions()
     config_file = Path(filename)
     if config_file.is_file():
+        import tomlkit
+
         global_params = {}
         try:
             with config_file.open("r") as f:
@@ -102,11 +109,14 @@ def load_params(ctx: click.Context, param: str, filename: Path) -> None:
         if params:
             global_params = params.pop("global", {})
 
-            ctx.default_map = params.get(ctx.info_name, {})
+            # status reports on extract so it shares its options
+            table = "extract" if ctx.info_name == "status" else ctx.info_name
+            ctx.default_map = params.get(table, {})
 
-            # use not shadowing name for input
-            if ctx.default_map and "input" in ctx.default_map:
-                ctx.default_map["input_"] = ctx.default_map.pop("input")
+            # use not shadowing name for input/format
+            for name, readable in SHADOWED_PARAMS.items():
+                if ctx.default_map and readable in ctx.default_map:
+                    ctx.default_map[name] = ctx.default_map.pop(readable)
 
             # populate 'default_map' with global params
             for k, v in global_params.items():
@@ -0,0 +1,580 @@
+from __future__ import annotations
+
+import io
+import time
+from collections import Counter
+from pathlib import Path
+from typing import IO, Callable, Dict, Iterator, List, Optional, Tuple
+
+import polars as pl
+
+from .fastq import FastqError, open_fastq, read_fastq
+from .options import PycashierOpts
+from .term import term
+
+# number of fastq records processed together
+CHUNK_SIZE = 200_000
+# batches of barcode counts kept before folding them into the running counts
+FOLD_BATCHES = 32
+# cutadapt's default minimum overlap for partial adapter matches
+MIN_OVERLAP = 3
+# bases with a lower phred score count against a mate's barcode when they conflict
+LOW_QUALITY = 20
+COMPLEMENT = {"A": "T", "C": "G", "G": "C", "T": "A"}
+
+# alignment flags, mirroring cutadapt's semiglobal aligner
+START_WITHIN_ADAPTER = 1
+START_WITHIN_READ = 2
+STOP_WITHIN_ADAPTER = 4
+STOP_WITHIN_READ = 8
+# 5' adapter: full match anywhere or a suffix overhanging the start of the read
+FRONT = START_WITHIN_ADAPTER | START_WITHIN_READ | STOP_WITHIN_READ
+# 3' adapter: full match anywhere or a prefix overhanging the end of the read
+BACK = START_WITHIN_READ | STOP_WITHIN_ADAPTER | STOP_WITHIN_READ
+
+# (region size or None for anywhere, pieces of which one must be present)
+Regions = List[Tuple[Optional[int], List[str]]]
+
+
+def locate(
+    adapter: str, seq: str, error: float, flags: int
+) -> Optional[Tuple[int, int]]:
+    """find the best alignment of an adapter within a read
+
+    A port of the dynamic programming in cutadapt's `Aligner.locate`
+    (unit costs, scores of +1/-1/-2 for match/mismatch/indel)
+    so that matches are selected exactly as cutadapt would.
+
+    Args:
+        adapter: Adapter sequence.
+        seq: Read sequence.
+        error: Maximum error rate relative to the aligned adapter length.
+        flags: Which ends of the adapter and read may be skipped.
+    Returns:
+        Start and stop of the match in `seq`, None if there is no match.
+    """
+    m, n = len(adapter), len(seq)
+    start_in_ref = flags & START_WITHIN_ADAPTER
+    start_in_query = flags & START_WITHIN_READ
+    stop_in_ref = flags & STOP_WITHIN_ADAPTER
+    stop_in_query = flags & STOP_WITHIN_READ
+    k = int(error * m)
+
+    max_n = n if start_in_query else min(n, m + k)
+    min_n = 0 if stop_in_query else max(0, n - m - k)
+    rows = range(m + 1)
+    if start_in_ref and start_in_query:
+        score = [0] * (m + 1)
+        cost = [min(i, min_n) for i in rows]
+        origin = [min_n - i for i in rows]
+    elif start_in_ref:
+        score = [0] * (m + 1)
+        cost = [min_n] * (m + 1)
+        origin = [min(0, min_n - i) for i in rows]
+    elif start_in_query:
+        score = [-2 * i for i in rows]
+        cost = list(rows)
+        origin = [max(0, min_n - i) for i in rows]
+    else:
+        score = [-2 * i for i in rows]
+        cost = [max(i, min_n) for i in rows]
+        origin = [0] * (m + 1)
+
+    unset = m + n + 1
+    best_cost, best_origin, best_score = unset, 0, 0
+    best_ref_stop, best_query_stop = m, n
+    last = m if start_in_ref else min(m, k + 1)
+    origin_inc, cost_inc, score_inc = (1, 0, 0) if start_in_query else (0, 1, -2)
+    last_filled = 0
+
+    for j in range(min_n + 1, max_n + 1):
+        d_cost, d_origin, d_score = cost[0], origin[0], score[0]
+        origin[0] += origin_inc
+        cost[0] += cost_inc
+        score[0] += score_inc
+        base = seq[j - 1]
+        for i in range(1, last + 1):
+            if adapter[i - 1] == base:
+                c, o, s = d_cost, d_origin, d_score + 1
+            else:
+                diagonal = d_cost + 1
+                insertion = cost[i] + 1
+                deletion = cost[i - 1] + 1
+                if diagonal <= deletion and diagonal <= insertion:
+                    c, o, s = diagonal, d_origin, d_score - 1
+                elif deletion <= insertion:
+                    c, o, s = deletion, origin[i - 1], score[i - 1] - 2
+                else:
+                    c, o, s = insertion, origin[i], score[i] - 2
+            d_cost, d_origin, d_score = cost[i], origin[i], score[i]
+            cost[i], origin[i], score[i] = c, o, s
+
+        last_filled = last
+        while last >= 0 and cost[last] > k:
+            last -= 1
+        if last < m:
+            last += 1
+        elif stop_in_query:
+            c, o, s = cost[m], origin[m], score[m]
+            length = m + min(o, 0)
+            if (length >= MIN_OVERLAP and c <= length * error) and (
+                best_cost == unset
+                or (o <= best_origin + m // 2 and s > best_score)
+                or (length > m + min(best_origin, 0) and s > best_score)
+            ):
+                best_cost, best_origin, best_score = c, o, s
+                best_ref_stop, best_query_stop = m, j
+                if c == 0 and o >= 0:
+                    # exact full length match, cannot be improved upon
+                    break
+
+    if max_n == n:
+        # partial matches of the adapter running off the end of the read
+        for i in range(last_filled, (0 if stop_in_ref else m) - 1, -1):
+            c, o, s = cost[i], origin[i], score[i]
+            length = i + min(o, 0)
+            if (length >= MIN_OVERLAP and c <= length * error) and (
+                best_cost == unset
+                or (o <= best_origin + m // 2 and s > best_score)
+                or (length > best_ref_stop + min(best_origin, 0) and s > best_score)
+            ):
+                best_cost, best_origin, best_score = c, o, s
+                best_ref_stop, best_query_stop = i, n
+
+    if best_cost == unset:
+        return None
+    return max(best_origin, 0), best_query_stop
+
+
+def _regions(adapter: str, error: float, front: bool) -> Regions:
+    """pieces of an adapter which any acceptable match must contain
+
+    By the pigeonhole principle a match with e errors contains one of
+    e + 1 pieces of the adapter exactly. Partial matches overhanging
+    the end of the read only need to be searched for near that end.
+
+    Args:
+        adapter: Adapter sequence.
+        error: Maximum error rate.
+        front: Whether this is a 5' (FRONT) or 3' (BACK) adapter.
+    """
+    if not front:
+        return [
+            (size, [kmer[::-1] for kmer in kmers])
+            for size, kmers in _regions(adapter[::-1], error, front=True)
+        ]
+    m = len(adapter)
+
+    def pieces(seq: str, errors: int) -> List[str]:
+        bounds = [round(i * len(seq) / (errors + 1)) for i in range(errors + 2)]
+        return [seq[bounds[i] : bounds[i + 1]] for i in range(errors + 1)]
+
+    regions: Regions = [(None, pieces(adapter, int(error * m)))]
+    # lengths of partial matches grouped by their number of allowed errors
+    by_errors: Dict[int, List[int]] = {}
+    for length in range(MIN_OVERLAP, m):
+        by_errors.setdefault(int(error * length), []).append(length)
+    for errors, lengths in by_errors.items():
+        regions.append(
+            (max(lengths) + errors, pieces(adapter[m - min(lengths) :], errors))
+        )
+    return regions
+
+
+def _could_match(seq: str, regions: Regions, front: bool) -> bool:
+    for size, kmers in regions:
+        region = seq if size is None else seq[:size] if front else seq[-size:]
+        if any(kmer in region for kmer in kmers):
+            return True
+    return False
+
+
+def _could_match_expr(col: str, regions: Regions, front: bool) -> pl.Expr:
+    exprs = []
+    for size, kmers in regions:
+        region = pl.col(col)
+        if size is not None:
+            region = region.str.slice(0, size) if front else region.str.slice(-size)
+        exprs.append(region.str.contains_any(kmers))
+    return pl.any_horizontal(exprs)
+
+
+class BarcodeExtractor:
+    """extract barcodes flanked by a linked pair of adapters
+
+    Equivalent to `cutadapt -g UPSTREAM...DOWNSTREAM --max-n=0 -n 2 --trimmed-only`
+    with a minimum/maximum length. Reads containing exact copies of both
+    adapters are handled in bulk with polars, the remainder are aligned
+    like cutadapt if they could contain an adapter within the `--error` rate.
+    """
+
+    def __init__(
+        self,
+        upstream: str,
+        downstream: str,
+        error: float,
+        min_length: int,
+        max_length: int,
+    ) -> None:
+        self.upstream = upstream.upper()
+        self.downstream = downstream.upper()
+        self.error = error
+        self.min_length = min_length
+        self.max_length = max_length
+        self.reads = 0
+        self._front = _regions(self.upstream, error, front=True)
+        self._back = _regions(self.downstream, error, front=False)
+
+    @classmethod
+    def from_opts(cls, opts: PycashierOpts) -> BarcodeExtractor:
+        return cls(
+            opts.upstream_adapter,
+            opts.downstream_adapter,
+            opts.error,
+            opts.length - opts.distance,
+            opts.length + opts.distance,
+        )
+
+    def _candidates(self, col: str) -> pl.Expr:
+        return _could_match_expr(col, self._front, front=True) & _could_match_expr(
+            col, self._back, front=False
+        )
+
+    def _trim_back(self, rest: str) -> Optional[str]:
+        """remove the downstream adapter from the remainder of a read"""
+        if not _could_match(rest, self._back, front=False):
+            return None
+        if not (back := locate(self.downstream, rest, self.error, BACK)):
+            return None
+        return rest[: back[0]]
+
+    def _trim(self, seq: str) -> Optional[str]:
+        """remove the linked adapters from a single read"""
+        if not (front := locate(self.upstream, seq, self.error, FRONT)):
+            return None
+        return self._trim_back(seq[front[1] :])
+
+    def _align(self, df: pl.DataFrame, col: str, trim: Callable) -> pl.DataFrame:
+        """align each distinct sequence in a column once"""
+        unique = df.get_column(col).unique()
+        return df.join(
+            pl.DataFrame(
+                {col: unique, "barcode": [trim(seq) for seq in unique]},
+                schema={col: pl.String, "barcode": pl.String},
+            ),
+            on=col,
+            how="left",
+        )
+
+    def _extract(self, seqs: pl.Series) -> pl.DataFrame:
+        """barcodes passing the length and N filters and the index of their read"""
+        self.reads += len(seqs)
+        df = (
+            seqs.alias("seq")
+            .to_frame()
+            .with_row_index("i")
+            .with_columns(
+                rest=pl.col("seq").str.slice(
+                    pl.col("seq").str.find(self.upstream, literal=True)
+                    + len(self.upstream)
+                )
+            )
+            .with_columns(end=pl.col("rest").str.find(self.downstream, literal=True))
+        )
+        trimmed = pl.concat(
+            [
+                # exact upstream and downstream adapters
+                df.filter(pl.col("end").is_not_null()).select(
+                    "i", barcode=pl.col("rest").str.slice(0, pl.col("end"))
+                ),
+                # exact upstream adapter, approximate or partial downstream adapter
+                self._align(
+                    df.filter(pl.col("rest").is_not_null() & pl.col("end").is_null()),
+                    "rest",
+                    self._trim_back,
+                ).select("i", "barcode"),
+                # approximate upstream adapter
+                self._align(
+                    df.filter(pl.col("rest").is_null() & self._candidates("seq")),
+                    "seq",
+                    self._trim,
+                ).select("i", "barcode"),
+            ]
+        ).drop_nulls()
+
+        # cutadapt's `-n 2` searches the trimmed read for the adapters once more
+        trimmed = trimmed.with_columns(again=self._candidates("barcode"))
+        barcodes = pl.concat(
+            [
+                trimmed.filter(~pl.col("again")).select("i", "barcode"),
+                self._align(
+                    trimmed.filter(pl.col("again")).select("i", seq="barcode"),
+                    "seq",
+                    lambda seq: self._trim(seq) or seq,
+                ).select("i", "barcode"),
+            ]
+        )
+        return barcodes.filter(
+            pl.col("barcode")
+            .str.len_chars()
+            .is_between(self.min_length, self.max_length),
+            ~pl.col("barcode").str.contains("N", literal=True),
+        )
+
+    def extract(self, seqs: pl.Series) -> pl.Series:
+        """extract barcodes from a batch of read sequences
+
+        Args:
+            seqs: Read sequences.
+        Returns:
+            Barcodes passing the length and N filters.
+        """
+        return self._extract(seqs).get_column("barcode")
+
+    def extract_each(self, seqs: pl.Series) -> pl.Series:
+        """extract the barcode of each read in a batch
+
+        Args:
+            seqs: Read sequences.
+        Returns:
+            Barcode of each read, null if it has none passing the filters.
+        """
+        barcodes = self._extract(seqs).sort("i")
+        return pl.Series("barcode", [None] * len(seqs), dtype=pl.String).scatter(
+            barcodes.get_column("i"), barcodes.get_column("barcode")
+        )
+
+
+def read_sequences(reads: IO[str], chunk_size: int = CHUNK_SIZE) -> Iterator[pl.Series]:
+    """yield read sequences from a fastq stream in chunks
+
+    Args:
+        reads: Fastq formatted text stream.
+        chunk_size: Number of records per chunk.
+    """
+    for batch in read_fastq(reads, chunk_size, fields=("seq",)):
+        yield batch.get_column("seq")
+
+
+def extract_barcodes(
+    reads: IO[str], out_file: Path, extractor: BarcodeExtractor
+) -> bool | None:
+    """extract and count barcodes from a fastq stream
+
+    Args:
+        reads: Fastq formatted text stream.
+        out_file: TSV file to write barcode counts to.
+        extractor: Configured barcode extractor.
+    """
+    start = time.perf_counter()
+    counts = BarcodeCounts()
+    try:
+        with term.progress("extracting", unit="reads") as update:
+            for seqs in read_sequences(reads):
+                counts.add(extractor.extract(seqs))
+                update(advance=len(seqs))
+    except FastqError as e:
+        term.log.error(
+            f"failed to extract barcodes for: {out_file}\n{e}, "
+            "ensure fastq was not corrupted and contains all reads"
+        )
+        return True
+    elapsed = time.perf_counter() - start
+
+    if (total := write_counts(counts.collect(), out_file)) is None:
+        return True
+    term.log.info(
+        f"extracted {total} barcodes from {extractor.reads} reads "
+        f"({extractor.reads / max(elapsed, 1e-9):,.0f} reads/s)"
+    )
+
+
+class BarcodeCounts:
+    """running counts of barcodes extracted in batches
+
+    The counts of each batch are kept and only folded into the running counts
+    every `FOLD_BATCHES` batches, so folding costs the number of unique barcodes
+    once per fold rather than once per batch while memory stays bounded.
+    """
+
+    def __init__(self) -> None:
+        self._counts: Optional[pl.DataFrame] = None
+        self._batches: List[pl.DataFrame] = []
+
+    def add(self, barcodes: pl.Series) -> None:
+        """count the barcodes of a batch
+
+        Args:
+            barcodes: Barcodes extracted from a batch, null if none was found.
+        """
+        batch = barcodes.drop_nulls().rename("barcode").value_counts(name="count")
+        self._batches.append(batch.with_columns(pl.col("count").cast(pl.Int64)))
+        if len(self._batches) >= FOLD_BATCHES:
+            self._fold()
+
+    def _fold(self) -> None:
+        frames = (
+            self._batches if self._counts is None else [self._counts, *self._batches]
+        )
+        self._counts = pl.concat(frames).group_by("barcode").agg(pl.col("count").sum())
+        self._batches = []
+
+    def collect(self) -> Optional[pl.DataFrame]:
+        """barcode counts of every batch, None if there were no batches"""
+        if self._batches:
+            self._fold()
+        return self._counts
+
+
+def write_counts(counts: Optional[pl.DataFrame], out_file: Path) -> Optional[int]:
+    """write barcode counts as a table sorted by count
+
+    Args:
+        counts: Barcode counts of every batch.
+        out_file: TSV file to write barcode counts to.
+    Returns:
+        Total number of barcodes, None if none were found.
+    """
+    if counts is None or counts.height == 0:
+        term.log.error(
+            f"failed to extract barcodes for: {out_file}\n"
+            "no barcodes found, check adapters and error rate"
+        )
+        return None
+
+    df = counts.sort(["count", "barcode"], descending=[True, False])
+    df.write_csv(out_file, separator="\t", include_header=False)
+    return int(df.get_column("count").sum())
+
+
+def extract_barcodes_from_file(
+    fastq: Path, out_file: Path, extractor: BarcodeExtractor
+) -> bool | None:
+    """extract and count barcodes from a plain or gzipped fastq
+
+    Args:
+        fastq: Fastq file to extract barcodes from.
+        out_file: TSV file to write barcode counts to.
+        extractor: Configured barcode extractor.
+    """
+    with open_fastq(fastq) as reads:
+        return extract_barcodes(reads, out_file, extractor)
+
+
+def extract_barcodes_from_stream(
+    reads: IO[bytes], out_file: Path, extractor: BarcodeExtractor
+) -> bool | None:
+    """extract and count barcodes from a binary stream, i.e. a pipe"""
+    return extract_barcodes(io.TextIOWrapper(reads), out_file, extractor)
+
+
+def reverse_complement(seq: pl.Expr) -> pl.Expr:
+    return seq.str.reverse().str.replace_many(
+        list(COMPLEMENT), list(COMPLEMENT.values())
+    )
+
+
+def low_quality_bases(mate: str) -> pl.Expr:
+    """number of bases below `LOW_QUALITY` within a mate's barcode"""
+    barcode = pl.col(f"barcode{mate}")
+    start = pl.col(f"seq{mate}").str.find(barcode, literal=True)
+    return (
+        pl.col(f"qual{mate}")
+        .str.slice(start, barcode.str.len_chars())
+        .str.count_matches(f"[!-{chr(33 + LOW_QUALITY - 1)}]")
+    )
+
+
+def reconcile_mates(mates: pl.DataFrame) -> pl.DataFrame:
+    """call a single barcode for each read pair
+
+    Agreeing mates, or a barcode found in only one mate, are taken as is.
+    Conflicting barcodes are resolved in favor of the mate with fewer
+    low quality bases within its barcode and discarded if they're tied.
+
+    Args:
+        mates: Sequence, quality and barcode of each mate (seq1, qual1, barcode1, ...)
+            with R2 reverse complemented.
+    Returns:
+        Dataframe of the barcode of each pair and how it was called.
+    """
+    b1, b2 = pl.col("barcode1"), pl.col("barcode2")
+    low1, low2 = low_quality_bases("1"), low_quality_bases("2")
+    return mates.select(
+        pl.when(b1 == b2)
+        .then(pl.struct(barcode=b1, call=pl.lit("agreed")))
+        .when(b1.is_null() & b2.is_null())
+        .then(pl.struct(barcode=pl.lit(None, pl.String), call=pl.lit("none")))
+        .when(b2.is_null())
+        .then(pl.struct(barcode=b1, call=pl.lit("single")))
+        .when(b1.is_null())
+        .then(pl.struct(barcode=b2, call=pl.lit("single")))
+        .when(low1 < low2)
+        .then(pl.struct(barcode=b1, call=pl.lit("quality")))
+        .when(low2 < low1)
+        .then(pl.struct(barcode=b2, call=pl.lit("quality")))
+        .otherwise(pl.struct(barcode=pl.lit(None, pl.String), call=pl.lit("conflict")))
+        .struct.unnest()
+    )
+
+
+def extract_barcodes_from_pairs(
+    reads: IO[bytes], out_file: Path, extractor: BarcodeExtractor
+) -> bool | None:
+    """extract and count barcodes from both mates of interleaved read pairs
+
+    Barcodes are extracted from R1 and the reverse complement of R2
+    independently and reconciled by `reconcile_mates`.
+
+    Args:
+        reads: Interleaved fastq stream of R1 and R2, i.e. from `fastp --stdout`.
+        out_file: TSV file to write barcode counts to.
+        extractor: Configured barcode extractor.
+    """
+    start = time.perf_counter()
+    counts = BarcodeCounts()
+    calls: Counter = Counter()
+    try:
+        with term.progress("extracting", unit="pairs") as update:
+            # batches hold an even number of records so pairs are never split
+            for batch in read_fastq(
+                io.TextIOWrapper(reads), 2 * CHUNK_SIZE, fields=("seq", "qual")
+            ):
+                if batch.height % 2:
+                    raise FastqError("interleaved fastq ends with an unpaired read")
+                r1 = batch.gather_every(2)
+                r2 = batch.gather_every(2, offset=1).select(
+                    reverse_complement(pl.col("seq")), pl.col("qual").str.reverse()
+                )
+                called = reconcile_mates(
+                    pl.DataFrame(
+                        {
+                            "seq1": r1.get_column("seq"),
+                            "qual1": r1.get_column("qual"),
+                            "barcode1": extractor.extract_each(r1.get_column("seq")),
+                            "seq2": r2.get_column("seq"),
+                            "qual2": r2.get_column("qual"),
+                            "barcode2": extractor.extract_each(r2.get_column("seq")),
+                        }
+                    )
+                )
+                calls.update(dict(called.get_column("call").value_counts().iter_rows()))
+                counts.add(called.get_column("barcode"))
+                update(advance=r1.height)
+    except FastqError as e:
+        term.log.error(
+            f"failed to extract barcodes for: {out_file}\n{e}, "
+            "ensure fastq was not corrupted and contains all reads"
+        )
+        return True
+    elapsed = time.perf_counter() - start
+
+    if (total := write_counts(counts.collect(), out_file)) is None:
+        return True
+    pairs = extractor.reads // 2
+    term.log.info(
+        f"extracted {total} barcodes from {pairs} read pairs "
+        f"({pairs / max(elapsed, 1e-9):,.0f} pairs/s), "
+        f"{calls['agreed']} agreed, {calls['single']} from a single mate, "
+        f"{calls['quality']} resolved by quality and discarded {calls['conflict']} conflicting"
+    )
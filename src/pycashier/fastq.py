@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import gzip
+from itertools import islice
+from pathlib import Path
+from typing import IO, Iterator, Sequence
+
+import polars as pl
+
+# number of fastq records read together
+CHUNK_SIZE = 200_000
+FIELDS = ("name", "seq", "qual")
+
+
+class FastqError(ValueError):
+    """malformed or truncated fastq"""
+
+
+def open_fastq(path: Path) -> IO[str]:
+    """open a plain or gzipped fastq as text
+
+    Args:
+        path: Fastq file, gzipped if it ends with .gz.
+    """
+    if path.name.endswith(".gz"):
+        return gzip.open(path, "rt")
+    return path.open()
+
+
+def read_fastq(
+    reads: IO[str], chunk_size: int = CHUNK_SIZE, fields: Sequence[str] = FIELDS
+) -> Iterator[pl.DataFrame]:
+    """yield batches of fastq records as dataframes
+
+    Records are split by line rather than parsed as delimited text,
+    so any character may appear in names or qualities. Only `chunk_size`
+    records are held in memory at a time regardless of the size of the file.
+
+    Args:
+        reads: Fastq formatted text stream.
+        chunk_size: Number of records per batch.
+        fields: Columns to yield from "name" (without the leading @), "seq" and "qual".
+    Yields:
+        Dataframe of the requested fields.
+    Raises:
+        FastqError: If a record is truncated or malformed.
+    """
+    records = 0
+    while lines := list(islice(reads, 4 * chunk_size)):
+        if len(lines) % 4:
+            raise FastqError(
+                f"fastq is truncated after {records + len(lines) // 4} records"
+            )
+        columns = {
+            "header": pl.Series(lines[0::4], dtype=pl.String),
+            "seq": pl.Series(lines[1::4], dtype=pl.String),
+            "separator": pl.Series(lines[2::4], dtype=pl.String),
+            "qual": pl.Series(lines[3::4], dtype=pl.String),
+        }
+        if not (
+            columns["header"].str.starts_with("@").all()
+            and columns["separator"].str.starts_with("+").all()
+        ):
+            raise FastqError(f"malformed fastq record after {records} records")
+        columns["name"] = columns["header"].str.slice(1)
+        records += len(columns["seq"])
+        yield pl.DataFrame(
+            [
+                columns[field].str.strip_chars_end("\r\n").alias(field)
+                for field in fields
+            ]
+        )
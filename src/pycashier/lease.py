@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import json
+import os
+import socket
+import threading
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from types import TracebackType
+from typing import Dict, Generator, Optional, Type
+
+from .term import term
+
+# seconds without a heartbeat after which a lease may be broken by another worker
+LEASE_SECONDS = 120
+# heartbeats per lease period, so a few can be missed on a busy file server
+HEARTBEATS = 4
+
+
+class Leases:
+    """claim samples with lock files in a directory shared by several workers
+
+    A lock is created by hard linking a unique file to `<sample>.lock`,
+    which is atomic even on NFS where `O_EXCL` may not be. While a sample is
+    held a heartbeat thread touches its lock, a lock whose modification time
+    is older than `lease` seconds belongs to a worker which died and is broken.
+    Times are compared against the modification time of a freshly written
+    file, so only the file server's clock matters.
+
+    Args:
+        directory: Directory of lock files, shared by every worker.
+        lease: Seconds without a heartbeat after which a lease is stale.
+    """
+
+    def __init__(self, directory: Path, lease: Optional[float] = None) -> None:
+        self.directory = directory
+        self.lease = lease or LEASE_SECONDS
+        # seconds between heartbeats and between attempts to claim held samples
+        self.poll = self.lease / HEARTBEATS
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._held: Dict[str, Path] = {}
+        self._tokens: Dict[str, str] = {}
+        self._lost: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(
+            target=self._beat, name="lease-heartbeat", daemon=True
+        )
+
+    def __enter__(self) -> Leases:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._heartbeat.start()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        tb: Optional[TracebackType],
+    ) -> None:
+        self._stop.set()
+        self._heartbeat.join()
+        for name in list(self._held):
+            self.release(name)
+
+    def _read(self, lock: Path) -> Dict[str, str]:
+        try:
+            data: Dict[str, str] = json.loads(lock.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+        return data
+
+    def _owns(self, name: str, lock: Path) -> bool:
+        return self._read(lock).get("token") == self._tokens.get(name)
+
+    def _beat(self) -> None:
+        """renew every held lease until stopped"""
+        while not self._stop.wait(self.poll):
+            with self._lock:
+                held = list(self._held.items())
+            for name, lock in held:
+                try:
+                    if self._owns(name, lock):
+                        os.utime(lock)
+                        continue
+                except FileNotFoundError:
+                    pass
+                with self._lock:
+                    # released while renewing it
+                    if self._held.pop(name, None) is None:
+                        continue
+                    self._lost[name].set()
+                term.log.error(
+                    f"lost the lease on {name}, another worker may be processing it"
+                )
+
+    def _break_stale(self, name: str, lock: Path, now: float) -> bool:
+        """remove a lock whose holder stopped renewing it
+
+        Returns:
+            True if the lock is gone and claiming should be retried.
+        """
+        try:
+            age = now - lock.stat().st_mtime
+        except FileNotFoundError:
+            return True
+        if age < self.lease:
+            return False
+        holder = self._read(lock).get("owner", "unknown")
+        stale = lock.with_name(f".{lock.name}.{uuid.uuid4().hex}.stale")
+        try:
+            os.rename(lock, stale)
+        except FileNotFoundError:
+            # broken by another worker first
+            return True
+        if now - stale.stat().st_mtime < self.lease:
+            # the lock was reclaimed between checking and renaming it, restore it
+            try:
+                os.link(stale, lock)
+            except FileExistsError:
+                pass
+            stale.unlink()
+            return False
+        stale.unlink()
+        term.log.warning(
+            f"broke the lease on {name} held by {holder}, "
+            f"not renewed for {age:.0f} seconds"
+        )
+        return True
+
+    def _claim(self, name: str) -> Optional[str]:
+        """try to create the lock for a sample
+
+        Returns:
+            None if claimed, otherwise the current holder.
+        """
+        lock = self.directory / f"{name}.lock"
+        token = uuid.uuid4().hex
+        tmp = self.directory / f".{name}.{token}.tmp"
+        tmp.write_text(json.dumps({"owner": self.owner, "token": token}))
+        try:
+            for _ in range(2):
+                try:
+                    os.link(tmp, lock)
+                except FileExistsError:
+                    # on NFS this may be a retransmitted link that was made,
+                    # so the link count decides
+                    pass
+                if tmp.stat().st_nlink == 2:
+                    with self._lock:
+                        self._held[name] = lock
+                        self._tokens[name] = token
+                        self._lost[name] = threading.Event()
+                    return None
+                if not self._break_stale(name, lock, now=tmp.stat().st_mtime):
+                    break
+            return self._read(lock).get("owner", "unknown")
+        finally:
+            tmp.unlink()
+
+    def release(self, name: str) -> None:
+        """remove the lock of a sample if it's still held by this worker"""
+        with self._lock:
+            lock = self._held.pop(name, None)
+        if lock and self._owns(name, lock):
+            lock.unlink(missing_ok=True)
+        with self._lock:
+            self._tokens.pop(name, None)
+            self._lost.pop(name, None)
+
+    @contextmanager
+    def claim(self, name: str) -> Generator[Optional[threading.Event], None, None]:
+        """hold the lease on a sample, unless another worker does
+
+        Args:
+            name: Sample name.
+        Yields:
+            None if another worker holds the sample, otherwise an event
+            set if the lease is lost before it's released.
+        """
+        if holder := self._claim(name):
+            term.log.debug(f"skipping {name}, claimed by {holder}")
+            yield None
+            return
+        term.log.debug(f"claimed {name} as {self.owner}")
+        try:
+            yield self._lost[name]
+        finally:
+            self.release(name)
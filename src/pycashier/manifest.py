@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import subprocess
+from functools import lru_cache
+from importlib.metadata import version
+from pathlib import Path
+from typing import Any, Dict, Optional, Sequence
+
+from .term import term
+
+# bytes hashed from the start and end of each file
+HASH_SIZE = 1 << 20
+
+
+def partial_path(file: Path) -> Path:
+    """temporary file written to before atomically replacing `file`"""
+    return file.with_name(f".partial.{file.name}")
+
+
+def file_fingerprint(file: Path) -> Optional[Dict[str, Any]]:
+    """size, modification time and a partial hash of a file
+
+    Only the first and last MiB are hashed so large fastqs are cheap to check.
+
+    Args:
+        file: File to fingerprint.
+    Returns:
+        Fingerprint or None if the file does not exist.
+    """
+    if not file.is_file():
+        return None
+    stat = file.stat()
+    digest = hashlib.blake2b(digest_size=16)
+    with file.open("rb") as f:
+        digest.update(f.read(HASH_SIZE))
+        if stat.st_size > HASH_SIZE:
+            f.seek(max(HASH_SIZE, stat.st_size - HASH_SIZE))
+            digest.update(f.read(HASH_SIZE))
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "hash": digest.hexdigest(),
+    }
+
+
+@lru_cache(maxsize=None)
+def tool_version(tool: str) -> str:
+    """version string of an external tool or pycashier itself
+
+    Args:
+        tool: Command used to invoke the tool, or "pycashier".
+    """
+    if tool == "pycashier":
+        return f"pycashier {version('pycashier')}"
+    try:
+        p = subprocess.run(
+            shlex.split(tool) + ["--version"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        )
+    except OSError:
+        return "unknown"
+    return next((line.strip() for line in p.stdout.splitlines() if line.strip()), "")
+
+
+@lru_cache(maxsize=None)
+def tool_key(tool: str) -> Any:
+    """identify the installed version of a tool without running it
+
+    Args:
+        tool: Command used to invoke the tool, or "pycashier".
+    Returns:
+        Resolved executable with its size and modification time.
+    """
+    if tool == "pycashier":
+        return tool_version(tool)
+    if not (exe := shutil.which(shlex.split(tool)[0])):
+        return "unknown"
+    stat = os.stat(exe)
+    return [exe, stat.st_size, stat.st_mtime_ns]
+
+
+def fingerprint(
+    inputs: Sequence[Path], tools: Sequence[str], **params: Any
+) -> Dict[str, Any]:
+    """fingerprint of everything a step's output depends on
+
+    Args:
+        inputs: Input files of the step.
+        tools: Commands used by the step.
+        **params: Options which affect the output.
+    """
+    # round trip through json so it compares equal to a recorded fingerprint
+    fp: Dict[str, Any] = json.loads(
+        json.dumps(
+            {
+                "inputs": {str(f.name): file_fingerprint(f) for f in inputs},
+                "tools": {tool: tool_version(tool) for tool in tools},
+                "params": params,
+            }
+        )
+    )
+    return fp
+
+
+class Manifest:
+    """record of how each output of a sample's pipeline was produced
+
+    Stored as json in `<pipeline>/manifest/<sample>.json`.
+    """
+
+    def __init__(self, pipeline: Path, name: str) -> None:
+        self.path = pipeline / "manifest" / f"{name}.json"
+        self._records: Optional[Dict[str, Dict[str, Any]]] = None
+        # pipelines from before the manifest existed have no manifest at all
+        self.legacy = False
+
+    @property
+    def records(self) -> Dict[str, Dict[str, Any]]:
+        # only read when needed, a sample in the state index may never use it
+        if self._records is None:
+            self._records = {}
+            self.legacy = not self.path.is_file()
+            if not self.legacy:
+                try:
+                    self._records = json.loads(self.path.read_text())
+                except json.JSONDecodeError:
+                    term.log.warning(f"ignoring unreadable manifest: {self.path}")
+        return self._records
+
+    def current(
+        self, step: str, output: Path, fp: Dict[str, Any], quiet: bool = False
+    ) -> bool:
+        """check whether a step's output is up to date
+
+        Outputs of a pipeline from before the manifest existed are assumed
+        to be current, otherwise an output without a record is stale.
+
+        Args:
+            step: Name of the step.
+            output: Output file of the step.
+            fp: Current fingerprint of the step.
+            quiet: If true, don't log the result.
+        Returns:
+            True if the step can be skipped.
+        """
+        log = (lambda msg: None) if quiet else term.log.debug
+        if not output.is_file():
+            log(f"missing output file: {output.name}")
+            return False
+        if not (record := self.records.get(step)):
+            if not self.legacy:
+                log(f"no manifest record for {output.name}")
+                return False
+            log(f"no manifest record for {output.name}, assuming it is current")
+            if not quiet:
+                self.record(step, output, fp)
+            return True
+        if record["fingerprint"] != fp:
+            log(f"inputs or parameters changed for: {output.name}")
+            return False
+        if record["output"] != file_fingerprint(output):
+            log(f"output file was modified since it was written: {output.name}")
+            return False
+        log(f"found output file: {output.name}")
+        return True
+
+    def record(self, step: str, output: Path, fp: Dict[str, Any]) -> None:
+        """save the fingerprint of a completed step
+
+        Args:
+            step: Name of the step.
+            output: Output file of the step.
+            fp: Fingerprint the output was produced with.
+        """
+        self.records[step] = {
+            "output": file_fingerprint(output),
+            "fingerprint": fp,
+        }
+        self.path.parent.mkdir(exist_ok=True)
+        tmp = partial_path(self.path)
+        tmp.write_text(json.dumps(self.records, indent=2))
+        tmp.replace(self.path)
@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from types import TracebackType
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Type
+
+# ru_maxrss is reported in bytes on macOS and kilobytes elsewhere
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+# usage of the calling thread, only available on linux
+RUSAGE_STEP = getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF)
+
+_local = threading.local()
+
+
+def wait_process(p: subprocess.Popen) -> int:
+    """wait for a child process and charge its resource usage to the current step
+
+    Args:
+        p: Process whose output has already been consumed.
+    Returns:
+        Exit code of the process.
+    """
+    if p.returncode is None:
+        _, status, rusage = os.wait4(p.pid, 0)
+        p.returncode = os.waitstatus_to_exitcode(status)
+        args = p.args if isinstance(p.args, (list, tuple)) else str(p.args).split()
+        add_subprocess(
+            Path(str(args[0])).name,
+            rusage.ru_utime,
+            rusage.ru_stime,
+            rusage.ru_maxrss * RSS_UNIT,
+        )
+    return p.returncode
+
+
+def add_subprocess(command: str, user: float, system: float, max_rss: int) -> None:
+    """charge the usage of a finished subprocess or worker to the current step
+
+    Args:
+        command: Name of the subprocess.
+        user: User cpu seconds.
+        system: System cpu seconds.
+        max_rss: Peak resident memory in bytes.
+    """
+    if (usage := getattr(_local, "usage", None)) is not None:
+        usage.subprocesses.append(
+            {"command": command, "user": user, "sys": system, "max_rss": max_rss}
+        )
+
+
+def peak_rss() -> int:
+    """high-water mark of pycashier's resident memory in bytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT
+
+
+class StepUsage:
+    """wall time, cpu time and peak memory of a single step
+
+    Subprocesses started by `run_cmd`/`run_pipe` are measured exactly with
+    `os.wait4` and worker processes report their own usage. In-process work
+    is measured with `getrusage(RUSAGE_THREAD)` for the thread running the
+    sample where available, which excludes polars' thread pool, and for the
+    whole process elsewhere. Peak memory is only known per subprocess,
+    the high-water mark of pycashier itself is reported once by `peak_rss`.
+
+    Args:
+        step: Name of the step.
+    """
+
+    def __init__(self, step: str) -> None:
+        self.step = step
+        self.wall = 0.0
+        self.process: Dict[str, float] = {}
+        self.subprocesses: List[Dict[str, Any]] = []
+        self._start: Tuple[float, resource.struct_rusage] | None = None
+
+    def __enter__(self) -> StepUsage:
+        self._previous = getattr(_local, "usage", None)
+        _local.usage = self
+        self._start = (time.perf_counter(), resource.getrusage(RUSAGE_STEP))
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        tb: Optional[TracebackType],
+    ) -> None:
+        assert self._start is not None
+        start, before = self._start
+        after = resource.getrusage(RUSAGE_STEP)
+        self.wall = time.perf_counter() - start
+        self.process = {
+            "user": after.ru_utime - before.ru_utime,
+            "sys": after.ru_stime - before.ru_stime,
+        }
+        _local.usage = self._previous
+
+    @property
+    def user(self) -> float:
+        return self.process.get("user", 0.0) + sum(
+            float(p["user"]) for p in self.subprocesses
+        )
+
+    @property
+    def sys(self) -> float:
+        return self.process.get("sys", 0.0) + sum(
+            float(p["sys"]) for p in self.subprocesses
+        )
+
+    @property
+    def max_rss(self) -> int:
+        """largest peak resident memory of any subprocess, 0 if there were none"""
+        return max((int(p["max_rss"]) for p in self.subprocesses), default=0)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "step": self.step,
+            "wall": self.wall,
+            "user": self.user,
+            "sys": self.sys,
+            "max_rss": self.max_rss,
+            "process": self.process,
+            "subprocesses": self.subprocesses,
+        }
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            break
+        size /= 1024
+    return f"{size:.1f} {unit}" if unit != "B" else f"{int(size)} B"
+
+
+def write_metrics(
+    pipeline: Path,
+    command: str,
+    threads: int,
+    jobs: int,
+    usage: Dict[str, Sequence[StepUsage]],
+) -> Path:
+    """save resource usage of each sample's steps for this run
+
+    Args:
+        pipeline: Pipeline directory, metrics are written to `<pipeline>/metrics`.
+        command: Pycashier subcommand.
+        threads: Total number of threads.
+        jobs: Number of concurrent samples.
+        usage: Usage of each step keyed by sample name.
+    Returns:
+        Path of the metrics json.
+    """
+    now = datetime.now()
+    # workers sharing a pipeline may finish within the same second
+    worker = f"{socket.gethostname()}-{os.getpid()}"
+    metrics = pipeline / "metrics" / f"{command}-{now:%Y%m%dT%H%M%S}-{worker}.json"
+    metrics.parent.mkdir(exist_ok=True)
+    metrics.write_text(
+        json.dumps(
+            {
+                "command": command,
+                "date": now.isoformat(timespec="seconds"),
+                "threads": threads,
+                "jobs": jobs,
+                "max_rss": peak_rss(),
+                "samples": {
+                    name: [step.to_dict() for step in steps]
+                    for name, steps in usage.items()
+                },
+            },
+            indent=2,
+        )
+    )
+    return metrics
@@ -16,7 +16,28 @@ import click
 
 from ._checks import pre_run_check
 from .config import load_params
-from .utils import validate_filter_args
+
+
+def validate_filter_args(ctx: click.Context) -> Dict[str, float]:
+    """validate filter argument from config and CLI
+
+    Args:
+        ctx: Click context.
+    Returns:
+        Dictionary defining the filter type and value.
+    """
+    if ctx.params["filter_count"] or ctx.params["filter_count"] == 0:
+        if ctx.get_parameter_source("filter_percent").value == 3:  # type: ignore
+            ctx.params["filter_percent"] = None
+            del ctx.params["filter_percent"]
+            return {"filter_count": ctx.params["filter_count"]}
+        else:
+            raise click.BadParameter(
+                "`--filter-count` and `--filter-percent` are mutually exclusive"
+            )
+    else:
+        del ctx.params["filter_count"]
+        return {"filter_percent": ctx.params["filter_percent"]}
 
 
 def init_check(ctx: click.Context, param: str, check: bool) -> None:
@@ -188,6 +209,14 @@ _options = [
         show_default=True,
         category="general",
     ),
+    Option(
+        ["-j", "--jobs"],
+        help="number of samples to process concurrently, sharing `--threads`",
+        default=1,
+        show_default=True,
+        type=click.IntRange(min=1),
+        category="general",
+    ),
     Option(
         ["-c", "--config"],
         help="read parameter values from config file",
@@ -262,12 +291,58 @@ _options = [
         is_flag=True,
         category="trim",
     ),
+    Option(
+        ["--prefilter"],
+        help="only keep reads containing a seed of either adapter before running cutadapt",
+        is_flag=True,
+        category="trim",
+    ),
     Option(
         ["--skip-trimming"],
         help="skip cutadapt trimming entirely and use reads as-is",
         is_flag=True,
         category="trim",
     ),
+    Option(
+        ["--extract-engine"],
+        help="tool used to extract barcodes, native runs in-process with polars",
+        default="cutadapt",
+        show_default=True,
+        type=click.Choice(["cutadapt", "native"], case_sensitive=False),
+        category="trim",
+    ),
+    Option(
+        ["--stream"],
+        help="pipe reads through fastp, extraction and counting without intermediate fastqs",
+        is_flag=True,
+        category="general",
+    ),
+    Option(
+        ["--claim"],
+        help="claim each sample with a lease in the pipeline directory so several workers can share it",
+        is_flag=True,
+        category="general",
+    ),
+    Option(
+        ["--paired"],
+        help="merge paired-end R1/R2 fastqs with fastp and stream them into extraction, implies --stream",
+        is_flag=True,
+        category="general",
+    ),
+    Option(
+        ["--paired-mode"],
+        help="how --paired reads are combined, mates extracts barcodes from each mate without merging",
+        default="merge",
+        show_default=True,
+        type=click.Choice(["merge", "mates"], case_sensitive=False),
+        category="general",
+    ),
+    Option(
+        ["--compress-intermediates"],
+        help="gzip the fastqs written to the pipeline directory",
+        is_flag=True,
+        category="general",
+    ),
     Option(
         ["-q", "--quality"],
         help="minimum PHRED quality for filtering reads",
@@ -298,6 +373,22 @@ _options = [
         type=click.IntRange(1, 8),
         category="cluster",
     ),
+    Option(
+        ["--cell-distance"],
+        help="levenshtein distance for clustering barcodes within each cell, 0 to skip",
+        default=0,
+        show_default=True,
+        type=click.IntRange(0, 2),
+        category="cluster",
+    ),
+    Option(
+        ["--cluster-engine"],
+        help="tool used to cluster barcodes, native runs in-process and supports `-d 1..2`",
+        default="starcode",
+        show_default=True,
+        type=click.Choice(["starcode", "native"], case_sensitive=False),
+        category="cluster",
+    ),
     Option(
         ["-fc", "--filter-count"],
         help="minium nominal number of reads",
@@ -325,6 +416,40 @@ _options = [
         show_default=True,
         category="scrna",
     ),
+    Option(
+        ["--format", "format_"],
+        help="file format of combined output, parquet and ipc (arrow) keep column types",
+        default="tsv",
+        show_default=True,
+        type=click.Choice(["tsv", "parquet", "ipc"], case_sensitive=False),
+        category="input/output",
+    ),
+    Option(
+        ["--sort"],
+        help="order rows by sample, count and barcode one sample at a time, or skip sorting",
+        default="sample",
+        show_default=True,
+        type=click.Choice(["sample", "none"], case_sensitive=False),
+        category="input/output",
+    ),
+    Option(
+        ["--incremental"],
+        help="keep combined samples in the pipeline directory and only add new or changed samples",
+        is_flag=True,
+        category="general",
+    ),
+    Option(
+        ["--whitelist"],
+        help="called cell barcodes, i.e. cellranger's barcodes.tsv.gz, reads from other cells are skipped",
+        type=click.Path(exists=True, dir_okay=False, path_type=Path),
+        category="input/output",
+    ),
+    Option(
+        ["--unmapped-only"],
+        help="only convert unmapped reads, using the index of bam files to skip mapped reads",
+        is_flag=True,
+        category="input/output",
+    ),
     Option(
         ["--no-overlap"],
         help="skip per lineage overlap column",
@@ -367,7 +492,7 @@ _options += [
     _make_deduplicated_opt(
         "input",
         "scrna",
-        help="source directory containing sam files from scRNA-seq",
+        help="source directory containing sam or bam files from scRNA-seq",
     ),
     _make_deduplicated_opt(
         "input",
@@ -383,7 +508,7 @@ _options += [
     _make_deduplicated_opt(
         "output",
         "receipt",
-        help="combined tsv of all samples found in input directory",
+        help="combined table of all samples found in input directory",
         type=click.Path(file_okay=True, dir_okay=False, path_type=Path),
         default="./combined.tsv",
     ),
@@ -394,7 +519,10 @@ optmap = OptionMap(
         "receipt": (
             "input-receipt",
             "output-receipt",
+            "format",
             "no-overlap",
+            "sort",
+            "incremental",
             *general_opts,
         ),
         "extract": (
@@ -410,12 +538,20 @@ optmap = OptionMap(
             "downstream-adapter",
             "unlinked-adapters",
             "skip-trimming",
+            "extract-engine",
+            "stream",
+            "paired",
+            "paired-mode",
+            "compress-intermediates",
             "ratio",
             "distance",
+            "cluster-engine",
             "filter-count",
             "filter-percent",
             "offset",
             "threads",
+            "jobs",
+            "claim",
             "yes",
             *general_opts,
         ),
@@ -424,6 +560,8 @@ optmap = OptionMap(
             "output-merge",
             "fastp-args-merge",
             "threads",
+            "jobs",
+            "claim",
             "yes",
             *general_opts,
         ),
@@ -436,7 +574,14 @@ optmap = OptionMap(
             "downstream-adapter",
             "cutadapt-args",
             "minimum-length",
+            "prefilter",
+            "cell-distance",
+            "ratio",
+            "whitelist",
+            "unmapped-only",
             "threads",
+            "jobs",
+            "claim",
             "yes",
             *general_opts,
         ),
@@ -459,17 +604,32 @@ class PycashierOpts:
     error = optmap.get("error")
     length = optmap.get("length")
     distance = optmap.get("distance")
+    cell_distance = optmap.get("cell-distance")
     ratio = optmap.get("ratio")
+    cluster_engine = optmap.get("cluster-engine")
     upstream_adapter = optmap.get("upstream-adapter")
     downstream_adapter = optmap.get("downstream-adapter")
     minimum_length = optmap.get("minimum-length")
     unlinked_adapters = optmap.get("unlinked-adapters")
     skip_trimming = optmap.get("skip-trimming")
+    extract_engine = optmap.get("extract-engine")
+    stream = optmap.get("stream")
+    paired = optmap.get("paired")
+    paired_mode = optmap.get("paired-mode")
+    compress_intermediates = optmap.get("compress-intermediates")
     offset = optmap.get("offset")
     cutadapt_args = optmap.get("cutadapt-args")
     filter_count = optmap.get("filter-count")
     filter_percent = optmap.get("filter-percent")
     no_overlap = optmap.get("no-overlap")
+    format_ = optmap.get("format")
+    incremental = optmap.get("incremental")
+    sort = optmap.get("sort")
+    unmapped_only = optmap.get("unmapped-only")
+    whitelist: Optional[Path] = optmap.get("whitelist")
+    prefilter = optmap.get("prefilter")
+    jobs = optmap.get("jobs")
+    claim = optmap.get("claim")
     yes = optmap.get("yes")
 
     def __init__(self, **kwargs: Any) -> None:
@@ -2,18 +2,28 @@ from __future__ import annotations
 
 import sys
 from collections import Counter
+from contextlib import ExitStack
 from pathlib import Path
-from typing import Any, Generator, List
+from typing import Any, List
 
 import click
 
 from .config import save_params
+from .lease import Leases
 from .merge import get_pefastqs
+from .metrics import write_metrics
 from .options import PycashierOpts
-from .receipt import receipt
-from .sample import ExtractSample, MergeSample, Sample, ScrnaSample
+from .sample import ExtractSample, MergeSample, ScrnaSample
+from .scheduler import run_samples
+from .state import StateIndex
 from .term import term
-from .termui import confirm_extract_samples, confirm_samples, print_params
+from .termui import (
+    confirm_extract_samples,
+    confirm_samples,
+    print_params,
+    show_sample_queue,
+    show_usage,
+)
 from .utils import filter_input_by_sample
 
 
@@ -54,6 +64,11 @@ class Pycashier:
         candidate_files = [
             f for f in self.opts.input_.iterdir() if not f.name.startswith(".")
         ]
+        if ".bam" in exts:
+            # bam indices sit alongside their bam files
+            candidate_files = [
+                f for f in candidate_files if f.suffix not in (".bai", ".csi")
+            ]
 
         if not candidate_files:
             term.print(
@@ -122,10 +137,28 @@ class Pycashier:
 
     def _process_samples(
         self, samples: List[ExtractSample] | List[MergeSample] | List[ScrnaSample]
-    ) -> Generator[Sample, None, None]:
-        for sample in samples:
-            term.log.debug(f"starting sample: {sample.name}")
-            yield sample
+    ) -> None:
+        with ExitStack() as stack:
+            # lock files are kept per command since sample names may be shared
+            leases = (
+                stack.enter_context(Leases(self.opts.pipeline / "locks" / self.mode))
+                if self.opts.claim
+                else None
+            )
+            run_samples(
+                samples, threads=self.opts.threads, jobs=self.opts.jobs, leases=leases
+            )
+        if not samples:
+            return
+        metrics = write_metrics(
+            self.opts.pipeline,
+            self.mode,
+            threads=self.opts.threads,
+            jobs=self.opts.jobs,
+            usage={sample.name: sample.usage for sample in samples},
+        )
+        term.log.debug(f"resource usage written to: {metrics}")
+        show_usage(samples)
 
     def _is_complete(
         self, samples: List[ExtractSample] | List[MergeSample] | List[ScrnaSample]
@@ -159,20 +192,41 @@ class Pycashier:
         anything succeeding the first period will be ignored by `[hl]pycashier[/]`.
 
         If your data is paired-end with overlapping barcodes,
-        see `[hl]pycashier merge[/]`.
+        use `[hl]--paired[/]` to merge and extract them in one pass
+        or see `[hl]pycashier merge[/]`.
         """
 
+        from .cluster import MAX_DISTANCE
+
         # validate that filter count and filter percent aren't both defined
         self.opts.update_filter(ctx)
 
-        with term.cash_in(f"checking {self.opts.pipeline}"):
-            samples = [
-                ExtractSample(fastq=f, opts=self.opts)
-                for f in self._get_input_files(
-                    exts=[".fastq", ".fastq.gz"],
+        if self.opts.cluster_engine == "native" and self.opts.distance > MAX_DISTANCE:
+            raise click.BadParameter(
+                f"`--cluster-engine native` supports a `--distance` of at most {MAX_DISTANCE}"
+            )
+
+        mates = self.opts.paired_mode == "mates"
+        if mates and not self.opts.paired:
+            term.log.warning("`--paired-mode` is ignored without `--paired`")
+            mates = False
+        if mates and self.opts.skip_trimming:
+            raise click.BadParameter(
+                "`--paired-mode mates` extracts barcodes from each mate "
+                "and can't be used with `--skip-trimming`"
+            )
+
+        # barcodes are extracted from each mate by the native engine
+        engine = "--paired-mode mates" if mates else "--extract-engine native"
+        if self.opts.extract_engine == "native" or mates:
+            if self.opts.unlinked_adapters:
+                raise click.BadParameter(
+                    f"`--unlinked-adapters` can't be used with `{engine}`"
                 )
-            ]
+            if ctx.get_parameter_source("cutadapt_args").value != 3:  # type: ignore
+                term.log.warning(f"`--cutadapt-args` are ignored by `{engine}`")
 
+        samples = self._extract_samples()
         confirm_extract_samples(samples, self.opts)
         self._is_complete(samples)
 
@@ -180,10 +234,60 @@ class Pycashier:
 
         samples = [sample for sample in samples if not sample.completed]
         self._log_samples(samples)
-        for sample in self._process_samples(samples):
-            sample.pipeline()
+        self._process_samples(samples)
         self._check_failure(samples)
 
+    def _extract_samples(self) -> List[ExtractSample]:
+        """check the outputs of each sample, reusing the state index where possible"""
+        state = StateIndex(
+            self.opts.pipeline,
+            dirs=[
+                self.opts.pipeline,
+                self.opts.pipeline / "manifest",
+                self.opts.output,
+            ],
+        )
+        with term.cash_in(f"checking {self.opts.pipeline}"):
+            if self.opts.paired:
+                # R1 and R2 of a sample share its name
+                self.check_duplicates = False
+                samples = [
+                    ExtractSample(
+                        fastq=fastqs["R1"],
+                        opts=self.opts,
+                        state=state,
+                        fastqR2=fastqs["R2"],
+                    )
+                    for fastqs in get_pefastqs(
+                        self._get_input_files(exts=[".fastq", ".fastq.gz"])
+                    ).values()
+                ]
+            else:
+                samples = [
+                    ExtractSample(fastq=f, opts=self.opts, state=state)
+                    for f in self._get_input_files(
+                        exts=[".fastq", ".fastq.gz"],
+                    )
+                ]
+        state.save()
+        return samples
+
+    def status(self, ctx: click.Context) -> None:
+        """
+        show which steps of [hl]extract[/] are complete for each sample
+
+        Accepts the same options as `[hl]pycashier extract[/]`
+        and reads the `[hl]extract[/]` table of the config file.
+        """
+        self.opts.update_filter(ctx)
+        samples = self._extract_samples()
+        show_sample_queue(
+            samples=samples,
+            completed_samples=[sample for sample in samples if sample.completed],
+            queue_all=False,
+            opts=self.opts,
+        )
+
     def merge(
         self,
     ) -> None:
@@ -209,8 +313,8 @@ class Pycashier:
         self.opts.output.mkdir(exist_ok=True)
 
         samples = [sample for sample in samples if not sample.completed]
-        for sample in samples:
-            sample.pipeline()
+        self._log_samples(samples)
+        self._process_samples(samples)
 
         self._check_failure(samples)
 
@@ -222,23 +326,22 @@ class Pycashier:
         \n
         \b
         Designed for interoperability with 10X scRNA-seq workflow.
-        After processing samples with `[hl]cellranger[/]` resulting
-        bam files should be converted to sam files using `[hl]samtools[/]`.
+        Accepts the bam files from `[hl]cellranger[/]` or sam files.
         \n
-        [i]NOTE[/]: You can speed this up by providing a sam file with only
-        the unmapped reads.
+        [i]NOTE[/]: You can speed this up with `[hl]--unmapped-only[/]`,
+        which uses the index of a bam file to skip the mapped reads.
         """
         samples = [
             ScrnaSample(sam=f, opts=self.opts)
-            for f in self._get_input_files(exts=[".sam"])
+            for f in self._get_input_files(exts=[".sam", ".bam"])
         ]
         confirm_samples(samples, self.opts)
         self._is_complete(samples)
         self.opts.output.mkdir(exist_ok=True)
 
         samples = [sample for sample in samples if not sample.completed]
-        for sample in samples:
-            sample.pipeline()
+        self._log_samples(samples)
+        self._process_samples(samples)
         self._check_failure(samples)
 
     def receipt(
@@ -248,6 +351,8 @@ class Pycashier:
         combine and summarize outputs of [hl]extract[/]
         """
 
+        from .receipt import receipt
+
         files = {f.name.split(".")[0]: f for f in self._get_input_files(exts=[".tsv"])}
         with term.cash_in("calculating"):
             receipt(files, self.opts)
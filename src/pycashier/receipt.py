@@ -1,19 +1,225 @@
+import json
 from pathlib import Path
-from typing import Dict, Tuple
+from typing import Any, Dict, Iterable, Optional, Tuple
 
 import polars as pl
 
+from .manifest import file_fingerprint, partial_path
 from .options import PycashierOpts
 from .term import term
 
+# file extension written for each output format
+FORMAT_SUFFIXES = {"tsv": ".tsv", "parquet": ".parquet", "ipc": ".arrow"}
 
-def gen_queries(sample: str, file: Path) -> pl.LazyFrame:
-    return pl.scan_csv(file, separator="\t").with_columns(
-        sample=pl.lit(sample),
-        percent=(pl.col("count") / pl.col("count").sum() * 100).round(5),
+
+def scan_outs(file: Path) -> pl.LazyFrame:
+    return pl.scan_csv(
+        file,
+        separator="\t",
+        schema_overrides={"barcode": pl.String, "count": pl.Int64},
+    )
+
+
+def gen_queries(sample: str, file: Path, samples: pl.Enum) -> pl.LazyFrame:
+    # the total is computed up front so the percent is a streamable projection
+    total = scan_outs(file).select(pl.col("count").sum()).collect().item()
+    return scan_outs(file).with_columns(
+        sample=pl.lit(sample, dtype=samples),
+        percent=(pl.col("count") / total * 100).round(5),
     )
 
 
+def overlap_index(frames: Iterable[pl.LazyFrame]) -> pl.DataFrame:
+    """samples each barcode was found in
+
+    A single hash aggregation keyed by barcode,
+    only one row per unique barcode is held in memory.
+    """
+    return (
+        pl.concat(lzdf.select("barcode", "sample") for lzdf in frames)
+        .group_by("barcode")
+        .agg(
+            pl.col("sample").cast(pl.String).sort().str.join(";").alias("samples"),
+            pl.len().alias("n_samples"),
+        )
+        .collect()
+    )
+
+
+def combine(
+    frames: Dict[str, pl.LazyFrame], index: Optional[pl.DataFrame], sort: str
+) -> pl.LazyFrame:
+    """concatenate samples and attach the overlap of each barcode
+
+    Args:
+        frames: Table of each sample keyed by name.
+        index: Output of `overlap_index`, None to skip the overlap columns.
+        sort: "sample" to order by sample, count and barcode (descending)
+            one sample at a time, "none" to skip sorting.
+    """
+    names = sorted(frames, reverse=True) if sort == "sample" else list(frames)
+    queries = []
+    for sample in names:
+        lzdf = frames[sample]
+        if index is not None:
+            # the index is the build side of the join, the sample
+            # is streamed through it, which doesn't preserve its order
+            lzdf = lzdf.join(index.lazy(), on="barcode", how="left")
+        if sort == "sample":
+            lzdf = lzdf.sort("count", "barcode", descending=True)
+        queries.append(lzdf)
+    return pl.concat(queries)
+
+
+class ReceiptStore:
+    """combined samples kept in the pipeline directory between runs
+
+    Each sample is stored once as `samples/<sample>.parquet` and
+    `overlap.parquet` holds the samples each barcode was found in.
+    `receipt.json` records the fingerprint of every included sample file,
+    so only new or changed samples are read and the overlap index
+    is updated in place rather than rebuilt.
+
+    Args:
+        path: Directory of the store, `<pipeline>/receipt`.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.samples_dir = path / "samples"
+        self.index_file = path / "overlap.parquet"
+        self.state_file = path / "receipt.json"
+        self.state: Dict[str, Any] = {}
+        if self.state_file.is_file():
+            try:
+                self.state = json.loads(self.state_file.read_text())
+            except json.JSONDecodeError:
+                term.log.warning(f"rebuilding unreadable receipt: {self.state_file}")
+        if self.state and not self.index_file.is_file():
+            term.log.warning(f"rebuilding receipt missing {self.index_file.name}")
+            self.state = {}
+
+    def partition(self, sample: str) -> Path:
+        return self.samples_dir / f"{sample}.parquet"
+
+    def _read_index(self) -> pl.DataFrame:
+        if self.state and self.index_file.is_file():
+            return pl.read_parquet(self.index_file)
+        return pl.DataFrame(
+            schema={"barcode": pl.String, "samples": pl.List(pl.String)}
+        )
+
+    def update(self, files: Dict[str, Path]) -> None:
+        """add new or changed samples and drop ones no longer in the input
+
+        Args:
+            files: Extract outputs keyed by sample name.
+        """
+        fingerprints = {
+            sample: file_fingerprint(file) for sample, file in files.items()
+        }
+        stale = [
+            sample
+            for sample, fp in self.state.items()
+            if fingerprints.get(sample) != fp
+        ]
+        new = [
+            sample
+            for sample, fp in fingerprints.items()
+            if self.state.get(sample) != fp
+        ]
+        removed = set(self.state) - set(fingerprints)
+        term.log.info(
+            f"Adding {len(new)} new or changed samples to the receipt, "
+            f"removing {len(removed)}."
+        )
+        if not (stale or new):
+            return
+
+        self.samples_dir.mkdir(parents=True, exist_ok=True)
+        for sample in new:
+            tmp = partial_path(self.partition(sample))
+            gen_queries(sample, files[sample], pl.Enum([sample])).with_columns(
+                pl.col("sample").cast(pl.String)
+            ).sink_parquet(tmp)
+            tmp.replace(self.partition(sample))
+
+        index = self._read_index()
+        if stale:
+            index = index.with_columns(
+                pl.col("samples").list.set_difference(pl.lit(stale))
+            ).filter(pl.col("samples").list.len() > 0)
+        added = (
+            pl.concat(pl.scan_parquet(self.partition(sample)) for sample in new)
+            .group_by("barcode")
+            .agg(pl.col("sample").alias("added"))
+            .collect()
+            if new
+            else pl.DataFrame(
+                schema={"barcode": pl.String, "added": pl.List(pl.String)}
+            )
+        )
+        index = index.join(added, on="barcode", how="full", coalesce=True).select(
+            "barcode",
+            samples=pl.concat_list(
+                pl.col("samples").fill_null([]),
+                pl.col("added").fill_null([]),
+            )
+            .list.unique()
+            .list.sort(),
+        )
+        tmp = partial_path(self.index_file)
+        index.write_parquet(tmp)
+        tmp.replace(self.index_file)
+
+        for sample in removed:
+            self.partition(sample).unlink(missing_ok=True)
+        self.state = fingerprints
+        tmp = partial_path(self.state_file)
+        tmp.write_text(json.dumps(self.state, indent=2))
+        tmp.replace(self.state_file)
+
+    def scan(self, sample: str, samples: pl.Enum) -> pl.LazyFrame:
+        """table of a stored sample
+
+        Args:
+            sample: Name of the sample.
+            samples: Enum of sample names.
+        """
+        return pl.scan_parquet(self.partition(sample)).with_columns(
+            pl.col("sample").cast(samples)
+        )
+
+    def overlap(self) -> pl.DataFrame:
+        return pl.read_parquet(self.index_file).select(
+            "barcode",
+            samples=pl.col("samples").list.join(";"),
+            n_samples=pl.col("samples").list.len().cast(pl.UInt32),
+        )
+
+
+def output_path(opts: PycashierOpts) -> Path:
+    """match the output file's extension to its format"""
+    suffix = FORMAT_SUFFIXES[opts.format_]
+    if opts.output.suffix in FORMAT_SUFFIXES.values() and opts.output.suffix != suffix:
+        output = opts.output.with_suffix(suffix)
+        term.log.warning(
+            f"writing {opts.format_} output to [b]{output}[/] instead of {opts.output}"
+        )
+        return output
+    return opts.output
+
+
+def sink(lzdf: pl.LazyFrame, output: Path, format_: str) -> None:
+    """stream the combined table to disk without collecting it"""
+    if format_ == "parquet":
+        lzdf.sink_parquet(output)
+    elif format_ == "ipc":
+        lzdf.sink_ipc(output)
+    else:
+        lzdf.sink_csv(output, separator="\t")
+
+
 def parse_column_not_found_error(message: str) -> Tuple[str, str]:
     contents = message.splitlines()
     file = contents[4].split()[2]
@@ -24,19 +230,23 @@ def receipt(files: Dict[str, Path], opts: PycashierOpts) -> None:
     term.log.info(f"Combining output files for {len(files)} samples.")
     term.log.debug("samples: " + ", ".join(files))
 
-    lzdf = pl.concat(gen_queries(sample, file) for sample, file in files.items())
-    if not opts.no_overlap:
-        lzdf = lzdf.join(
-            lzdf.group_by(pl.col("barcode"))
-            .agg(
-                pl.col("sample").alias("samples").sort(),
-                pl.col("sample").len().alias("n_samples"),
-            )
-            .with_columns(pl.col("samples").list.join(";")),
-            on=pl.col("barcode"),
-        ).sort("sample", "count", "barcode", descending=True)
+    # sample names are stored as an enum (categorical) column in parquet/arrow
+    samples = pl.Enum(sorted(files))
+    output = output_path(opts)
     try:
-        lzdf.collect().write_csv(opts.output, separator="\t")
+        if opts.incremental:
+            store = ReceiptStore(opts.pipeline / "receipt")
+            store.update(files)
+            frames = {sample: store.scan(sample, samples) for sample in files}
+            index = None if opts.no_overlap else store.overlap()
+        else:
+            frames = {
+                sample: gen_queries(sample, file, samples)
+                for sample, file in files.items()
+            }
+            index = None if opts.no_overlap else overlap_index(frames.values())
+        lzdf = combine(frames, index, opts.sort)
+        sink(lzdf, output, opts.format_)
     except pl.ColumnNotFoundError as e:
         col, file = parse_column_not_found_error(e.args[0])
         term.log.error(f"missing column [b red]{col}[/] in [b]{file}[/]")
@@ -1,22 +1,32 @@
 from __future__ import annotations
 
 import shutil
+import threading
 from enum import Enum
+from functools import partial, wraps
 from pathlib import Path
-from typing import Any, Callable, Dict, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from .deps import cutadapt, fastp, starcode
-from .filters import read_filter
+from .manifest import Manifest, fingerprint, partial_path, tool_key
+from .metrics import StepUsage
 from .options import PycashierOpts
-from .scrna import labeled_fastq_to_tsv, sam_to_name_labeled_fastq
+from .state import StateIndex, stat_key
 from .term import term
 from .utils import (
     check_output,
+    clustered_total,
+    count_barcodes,
     fastq_to_tsv,
     get_filter_count,
+    is_count_table,
     run_cmd,
+    run_pipe,
 )
 
+# NOTE: modules implementing steps in-process depend on polars, they are
+# imported by the steps themselves so checking samples doesn't load them
+
 
 class SampleStatus(Enum):
     COMPLETE = 0
@@ -26,6 +36,7 @@ class SampleStatus(Enum):
 
 
 def status_check(func: Callable) -> Callable:
+    @wraps(func)
     def wrapper(self: Sample, *args: Any, **kwargs: Any) -> None:
         if func(self, *args, **kwargs):
             self.status = SampleStatus.FAIL
@@ -37,6 +48,11 @@ class Sample:
     def __init__(self, name: str, opts: PycashierOpts) -> None:
         self.opts = opts
         self.name = name
+        # may be lowered by the scheduler to share cores between samples
+        self.threads = opts.threads
+        self.manifest = Manifest(opts.pipeline, name)
+        # set once a step runs, the outputs of every later step are stale
+        self.rerun = False
         self.status = (
             SampleStatus.COMPLETE
             if all(self.check().values())
@@ -44,10 +60,57 @@ class Sample:
         )
         self.steps: Tuple[Callable, ...]
         self.completed = self.status is SampleStatus.COMPLETE
+        self.usage: List[StepUsage] = []
+        # set when the lease on a shared pipeline is lost to another worker
+        self.lost: Optional[threading.Event] = None
 
     def check(self) -> Dict[str, bool]:
         raise NotImplementedError
 
+    def recheck(self) -> Dict[str, bool]:
+        """check the outputs on disk, bypassing any cached state"""
+        return self.check()
+
+    def _fingerprint(self, step: str) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def _run_step(
+        self, step: str, output: Path, msg: str, run: Callable[[Path], bool | None]
+    ) -> bool | None:
+        """run a step unless its output is current
+
+        The output is written to a temporary file and renamed once
+        the step succeeds, then recorded in the manifest.
+
+        Args:
+            step: Name of the step in the manifest.
+            output: Output file of the step.
+            msg: Text to display related to step.
+            run: Function writing the output to the path it is given.
+        """
+        fp = self._fingerprint(step)
+        if not self.rerun and self.manifest.current(step, output, fp):
+            return None
+        self.rerun = True
+
+        term.log.debug(msg)
+        tmp = partial_path(output)
+        with term.process(msg):
+            failed = run(tmp)
+        if failed or self._aborted():
+            tmp.unlink(missing_ok=True)
+            return True
+        tmp.replace(output)
+        self.manifest.record(step, output, fp)
+        return None
+
+    def _aborted(self) -> bool:
+        """check if another worker may have taken over the sample"""
+        if self.lost is None or not self.lost.is_set():
+            return False
+        term.log.error(f"{self.name}: aborting, the sample's lease was lost")
+        return True
+
     def finished(self, success: bool = True) -> None:
         symbol = (
             "[green]✔[/]"
@@ -59,7 +122,11 @@ class Sample:
     def pipeline(self) -> None:
         with term.cash_in(self.name):
             for step in self.steps:
-                step()
+                with StepUsage(step.__name__.lstrip("_")) as usage:
+                    step()
+                self.usage.append(usage)
+                if self.status == SampleStatus.INCOMPLETE and self._aborted():
+                    self.status = SampleStatus.FAIL
                 if self.status != SampleStatus.INCOMPLETE:
                     break
         if self.status == SampleStatus.INCOMPLETE:
@@ -69,9 +136,11 @@ class Sample:
 
 class ExtractFiles:
     def __init__(self, name: str, opts: PycashierOpts) -> None:
-        self.quality = opts.pipeline / f"{name}.q{opts.quality}.fastq"
-        self.barcode_fastq = self.quality.with_suffix(".barcode.fastq")
-        self.barcodes = self.quality.with_suffix(".barcodes.tsv")
+        prefix = f"{name}.q{opts.quality}"
+        gz = ".gz" if opts.compress_intermediates else ""
+        self.quality = opts.pipeline / f"{prefix}.fastq{gz}"
+        self.barcode_fastq = opts.pipeline / f"{prefix}.barcode.fastq{gz}"
+        self.barcodes = opts.pipeline / f"{prefix}.barcodes.tsv"
         # if opts.ratio doesn't look like an integer replace the decimal
         if int(opts.ratio) != opts.ratio:
             ratio_str = str(opts.ratio).replace(".", "_")
@@ -79,11 +148,13 @@ class ExtractFiles:
             ratio_str = str(int(opts.ratio))
         self.clustered = self.barcodes.with_suffix(f".r{ratio_str}d{opts.distance}.tsv")
 
-    def final(self, opts: PycashierOpts) -> Optional[Path]:
+    def final(self, opts: PycashierOpts, total: Optional[int] = None) -> Optional[Path]:
         if not self.clustered.is_file():
             return None
         if opts.filter_percent:
-            min_count = get_filter_count(self.clustered, float(opts.filter_percent))
+            min_count = get_filter_count(
+                self.clustered, float(opts.filter_percent), total=total
+            )
         else:
             min_count = opts.filter_count
         return (opts.output / self.clustered.name).with_suffix(
@@ -92,27 +163,146 @@ class ExtractFiles:
 
 
 class ExtractSample(Sample):
-    def __init__(self, fastq: Path, opts: PycashierOpts) -> None:
+    def __init__(
+        self,
+        fastq: Path,
+        opts: PycashierOpts,
+        state: Optional[StateIndex] = None,
+        fastqR2: Optional[Path] = None,
+    ) -> None:
         name = fastq.name.split(".")[0]
         self.fastq = fastq
+        self.fastqR2 = fastqR2
+        self.inputs = [fastq] + ([fastqR2] if fastqR2 else [])
+        self.state = state
         self.files = ExtractFiles(name=name, opts=opts)
-        self.steps = (
-            self._filter,
-            self._cutadapt,
-            self._fast2tsv,
-            self._starcode,
+        # barcodes are extracted from each mate in-process, without merging them
+        self.mates = fastqR2 is not None and opts.paired_mode == "mates"
+        self.native = (
+            opts.extract_engine == "native" or self.mates
+        ) and not opts.skip_trimming
+        # paired-end reads are merged by fastp on their way into extraction
+        self.stream = opts.stream or opts.paired
+        if self.stream:
+            steps: Tuple[Callable, ...] = (self._stream_extract,)
+        elif self.native:
+            steps = (self._filter, self._native_extract)
+        else:
+            steps = (self._filter, self._cutadapt, self._fast2tsv)
+        self.steps = steps + (
+            self._native_cluster if opts.cluster_engine == "native" else self._starcode,
             self._read_filter,
         )
         super().__init__(name, opts)
 
+    def _state_key(self) -> Dict[str, Any]:
+        """options and tools which determine the result of `check`"""
+        opts = self.opts
+        return {
+            "options": {
+                k: str(getattr(opts, k))
+                for k in (
+                    "output quality unqualified_percent fastp_args skip_trimming "
+                    "extract_engine stream paired paired_mode compress_intermediates "
+                    "error length "
+                    "upstream_adapter downstream_adapter unlinked_adapters "
+                    "cutadapt_args cluster_engine distance ratio filter_count "
+                    "filter_percent offset"
+                ).split()
+            },
+            "tools": [tool_key(tool) for tool in self._tools()],
+        }
+
+    def _tools(self) -> List[str]:
+        """tools used by the configured steps"""
+        tools = [fastp, "pycashier"]
+        if not (self.native or self.opts.skip_trimming):
+            tools.append(cutadapt)
+        if self.opts.cluster_engine != "native":
+            tools.append(starcode)
+        return tools
+
     def check(self) -> Dict[str, bool]:
+        if not self.state:
+            return self._check()
+
+        key = self._state_key()
+        if cached := self.state.get(self.name, key, self.inputs):
+            exists: Dict[str, bool] = cached["check"]
+            self.files_exist = exists
+            return exists
+
+        total = self._clustered_total()
+        exists = self._check(total)
+        files = self.files
+        self.state.set(
+            self.name,
+            key,
+            [*self.inputs, files.quality, files.barcode_fastq, files.barcodes]
+            + [files.clustered, self.manifest.path]
+            + ([final] if (final := files.final(self.opts, total)) else []),
+            check=exists,
+            total=total,
+        )
+        return exists
+
+    def recheck(self) -> Dict[str, bool]:
+        # the state index only re-stats inputs while its directories look unchanged,
+        # which misses outputs written since by another worker
+        return self._check(self._clustered_total())
+
+    def _clustered_total(self) -> Optional[int]:
+        """total reads of the clustered output, reused while it is unmodified"""
+        clustered = self.files.clustered
+        if not (self.opts.filter_percent and clustered.is_file()):
+            return None
+        if (
+            self.state
+            and (entry := self.state.entries.get(self.name))
+            and entry["values"].get("total") is not None
+            and entry["files"].get(str(clustered)) == stat_key(clustered)
+        ):
+            total: int = entry["values"]["total"]
+            return total
+        return clustered_total(clustered)
+
+    def _check(self, total: Optional[int] = None) -> Dict[str, bool]:
+        files = self.files
+        # steps producing each output, filtering and extraction
+        # are a single step when streaming
+        if self.stream:
+            outputs = {
+                "quality": [("stream", files.barcodes)],
+                "barcodes": [("stream", files.barcodes)],
+            }
+        elif self.native:
+            outputs = {
+                "quality": [("filter", files.quality)],
+                "barcodes": [("extract", files.barcodes)],
+            }
+        else:
+            outputs = {
+                "quality": [("filter", files.quality)],
+                "barcodes": [
+                    ("extract", files.barcode_fastq),
+                    ("count", files.barcodes),
+                ],
+            }
+        outputs["clustered"] = [("cluster", files.clustered)]
+
         exists = {}
-        for name in ("quality", "barcodes", "clustered"):
-            exists[name] = (file_exists := (f := getattr(self.files, name)).is_file())
-            if file_exists and f.stat().st_size == 0:
-                term.log.warning(f"{f} appears to be empty")
+        # an output is only current if everything upstream of it is too
+        current = True
+        for name, steps in outputs.items():
+            for step, f in steps:
+                current = current and self.manifest.current(
+                    step, f, self._fingerprint(step), quiet=True
+                )
+                if f.is_file() and f.stat().st_size == 0:
+                    term.log.warning(f"{f} appears to be empty")
+            exists[name] = current
 
-        if final := self.files.final(self.opts):
+        if current and (final := self.files.final(self.opts, total)):
             exists["final"] = (file_exists := final.is_file())
             # size of 'barcode count'
             if file_exists and final.stat().st_size <= 14:
@@ -122,30 +312,132 @@ class ExtractSample(Sample):
         self.files_exist = exists
         return exists
 
-    @status_check
-    def _filter(self) -> bool | None:
+    def _fingerprint(self, step: str) -> Dict[str, Any]:
+        """fingerprint of the inputs, tools and options of a step"""
+        opts = self.opts
+        filtering = dict(
+            quality=opts.quality,
+            unqualified_percent=opts.unqualified_percent,
+            fastp_args=opts.fastp_args,
+        )
+        extraction = dict(
+            skip_trimming=opts.skip_trimming,
+            extract_engine=opts.extract_engine,
+            error=opts.error,
+            length=opts.length,
+            distance=opts.distance,
+            upstream_adapter=opts.upstream_adapter,
+            downstream_adapter=opts.downstream_adapter,
+            unlinked_adapters=opts.unlinked_adapters,
+            cutadapt_args=opts.cutadapt_args,
+        )
+        extract_tools = (
+            [] if opts.skip_trimming else ["pycashier"] if self.native else [cutadapt]
+        )
+
+        if step == "filter":
+            return fingerprint([self.fastq], [fastp], **filtering)
+        elif step == "stream":
+            if self.fastqR2:
+                extraction.update(paired_mode=opts.paired_mode)
+            return fingerprint(
+                self.inputs, [fastp, *extract_tools], **filtering, **extraction
+            )
+        elif step == "extract":
+            return fingerprint([self.files.quality], extract_tools, **extraction)
+        elif step == "count":
+            return fingerprint([self.files.barcode_fastq], ["pycashier"])
+        elif step == "cluster":
+            return fingerprint(
+                [self.files.barcodes],
+                ["pycashier" if opts.cluster_engine == "native" else starcode],
+                cluster_engine=opts.cluster_engine,
+                distance=opts.distance,
+                ratio=opts.ratio,
+            )
+        raise ValueError(f"unknown step: {step}")
+
+    def _fastp_command(self, output: Optional[Path] = None) -> str:
+        """build the fastp quality filtering command
+
+        Paired-end reads are merged and only the merged reads are output,
+        unless extracting from each mate, then both are output interleaved.
+
+        Args:
+            output: File to write filtered reads to, stdout if None.
+        """
         json, html = (
             self.opts.pipeline / "qc" / f"{self.name}.{ext}" for ext in ("json", "html")
         )
-        msg = "quality filtering reads with fastp"
         (self.opts.pipeline / "qc").mkdir(exist_ok=True)
-
-        if not check_output(self.files.quality, msg):
-            command = (
-                "fastp "
-                f"-i {self.fastq} "
-                f"-o {self.files.quality} "
-                f"-q {self.opts.quality} "
+        if self.mates:
+            # mates are always streamed into extraction
+            reads = f"-i {self.fastq} -I {self.fastqR2} "
+            out = "--stdout "
+        elif self.fastqR2:
+            reads = f"-i {self.fastq} -I {self.fastqR2} --merge "
+            out = f"--merged_out {output} " if output else "--stdout "
+        else:
+            reads = f"-i {self.fastq} "
+            out = f"-o {output} " if output else "--stdout "
+        return (
+            fastp
+            + " "
+            + (
+                reads + out + f"-q {self.opts.quality} "
                 f"-u {self.opts.unqualified_percent} "
-                f"-w {self.opts.threads} "
+                f"-w {self.threads} "
                 f"-h {html} "
                 f"-j {json} "
-                f"{self.opts.fastp_args or ''} "
+                + ("-z 1 " if self.opts.compress_intermediates else "")
+                + f"{self.opts.fastp_args or ''} "
             )
-            with term.process(msg):
-                return run_cmd(
-                    command, self.name, self.files.quality, self.opts.verbose
+        )
+
+    def _cutadapt_command(
+        self, input: Path | str, output: Optional[Path] = None
+    ) -> str:
+        """build the cutadapt barcode extraction command
+
+        Args:
+            input: Fastq to extract barcodes from, "-" for stdin.
+            output: File to write barcodes to, stdout if None.
+        """
+        adapter_string = (
+            f"-g {self.opts.upstream_adapter} -a {self.opts.downstream_adapter}"
+            if self.opts.unlinked_adapters
+            else f"-g {self.opts.upstream_adapter}...{self.opts.downstream_adapter}"
+        )
+        return (
+            cutadapt
+            + " "
+            + (
+                f"-e {self.opts.error} "
+                f"-j {self.threads} "
+                f"--minimum-length={self.opts.length - self.opts.distance} "
+                f"--maximum-length={self.opts.length + self.opts.distance} "
+                f"{adapter_string} "
+                f"{self.opts.cutadapt_args or ''} "
+                + (
+                    "--compression-level 1 "
+                    if self.opts.compress_intermediates and output
+                    else ""
                 )
+                + (f"-o {output} " if output else "")
+                + f"{input}"
+            )
+        )
+
+    @status_check
+    def _filter(self) -> bool | None:
+        return self._run_step(
+            "filter",
+            self.files.quality,
+            "quality filtering reads with fastp",
+            lambda output: run_cmd(
+                self._fastp_command(output), self.name, output, self.opts.verbose
+            ),
+        )
 
     @status_check
     def _cutadapt(
@@ -153,67 +445,125 @@ class ExtractSample(Sample):
     ) -> bool | None:
         """perform quality filtering and extraction"""
 
-        msg = "extracting barcodes with cutadapt"
-        adapter_string = (
-            f"-g {self.opts.upstream_adapter} -a {self.opts.downstream_adapter}"
-            if self.opts.unlinked_adapters
-            else f"-g {self.opts.upstream_adapter}...{self.opts.downstream_adapter}"
+        def run(output: Path) -> bool | None:
+            if self.opts.skip_trimming:
+                shutil.copy(self.files.quality, output)
+                return None
+            return run_cmd(
+                self._cutadapt_command(self.files.quality, output),
+                self.name,
+                output,
+                self.opts.verbose,
+            )
+
+        return self._run_step(
+            "extract",
+            self.files.barcode_fastq,
+            "extracting barcodes with cutadapt",
+            run,
         )
 
-        if self.opts.skip_trimming:
-            shutil.copy(self.files.quality, self.files.barcode_fastq)
+    @status_check
+    def _native_extract(self) -> bool | None:
+        """extract and count barcodes in-process"""
+        from .extract import BarcodeExtractor, extract_barcodes_from_file
+
+        return self._run_step(
+            "extract",
+            self.files.barcodes,
+            "extracting barcodes",
+            lambda output: extract_barcodes_from_file(
+                self.files.quality, output, BarcodeExtractor.from_opts(self.opts)
+            ),
+        )
 
-        if not check_output(
-            self.files.quality.with_suffix(".barcode.fastq"),
-            msg,
-        ):
-            command = (
-                cutadapt
-                + " "
-                + (
-                    f"-e {self.opts.error} "
-                    f"-j {self.opts.threads} "
-                    f"--minimum-length={self.opts.length - self.opts.distance} "
-                    f"--maximum-length={self.opts.length + self.opts.distance} "
-                    f"{adapter_string} "
-                    f"{self.opts.cutadapt_args or ''} "
-                    f"-o {self.files.barcode_fastq} {self.files.quality}"
-                )
+    @status_check
+    def _stream_extract(self) -> bool | None:
+        """filter, extract and count barcodes without intermediate fastqs"""
+        from .extract import (
+            BarcodeExtractor,
+            extract_barcodes_from_pairs,
+            extract_barcodes_from_stream,
+        )
+
+        commands = [self._fastp_command()]
+        if self.mates:
+            msg = "streaming read pairs through fastp and extraction from each mate"
+            consumer: Callable = partial(
+                extract_barcodes_from_pairs,
+                extractor=BarcodeExtractor.from_opts(self.opts),
             )
-            with term.process(msg):
-                return run_cmd(
-                    command,
-                    self.name,
-                    self.files.barcode_fastq,
-                    self.opts.verbose,
-                )
+        elif self.native:
+            msg = "streaming reads through fastp and extraction"
+            consumer = partial(
+                extract_barcodes_from_stream,
+                extractor=BarcodeExtractor.from_opts(self.opts),
+            )
+        else:
+            msg = "streaming reads through fastp, cutadapt and counting"
+            if not self.opts.skip_trimming:
+                commands.append(self._cutadapt_command("-"))
+            consumer = count_barcodes
+
+        return self._run_step(
+            "stream",
+            self.files.barcodes,
+            msg,
+            lambda output: run_pipe(
+                commands, self.name, partial(consumer, out_file=output)
+            ),
+        )
 
     @status_check
     def _fast2tsv(self) -> bool | None:
-        if not check_output(self.files.barcodes, "converting fastq to tsv"):
-            return fastq_to_tsv(self.files.barcode_fastq, self.files.barcodes)
+        if self.files.barcodes.is_file() and not is_count_table(self.files.barcodes):
+            term.log.warning(
+                f"{self.files.barcodes} is from an older version of pycashier, regenerating"
+            )
+            self.files.barcodes.unlink()
+        return self._run_step(
+            "count",
+            self.files.barcodes,
+            "counting unique barcodes",
+            lambda output: fastq_to_tsv(self.files.barcode_fastq, output),
+        )
 
     @status_check
     def _starcode(self) -> bool | None:
         """cluster the barcodes using starcode"""
 
-        msg = "clustering barcodes with starcode"
-
-        if not check_output(self.files.clustered, msg):
+        def run(output: Path) -> bool | None:
             command = (
                 starcode
                 + " "
                 + (
                     f"-d {self.opts.distance} -r {self.opts.ratio} "
-                    f"-t {self.opts.threads} -i {self.files.barcode_fastq} -o {self.files.clustered}"
+                    f"-t {self.threads} -i {self.files.barcodes} -o {output}"
                 )
             )
-            with term.process(msg):
-                return run_cmd(
-                    command, self.name, self.files.clustered, self.opts.verbose
-                )
+            return run_cmd(command, self.name, output, self.opts.verbose)
+
+        return self._run_step(
+            "cluster", self.files.clustered, "clustering barcodes with starcode", run
+        )
+
+    @status_check
+    def _native_cluster(self) -> bool | None:
+        """cluster the barcodes in-process"""
+        from .cluster import cluster_barcodes
+
+        return self._run_step(
+            "cluster",
+            self.files.clustered,
+            "clustering barcodes",
+            lambda output: cluster_barcodes(
+                self.files.barcodes, output, self.opts.distance, self.opts.ratio
+            ),
+        )
 
     def _read_filter(self) -> None:
+        from .filters import read_filter
+
         if read_filter(self.files.clustered, self.opts):
             self.status = SampleStatus.WARN
         else:
@@ -250,7 +600,7 @@ class MergeSample(Sample):
                 + (
                     f"-i {self.fastqR1}  "
                     f"-I {self.fastqR2}  "
-                    f"-w {self.opts.threads} "
+                    f"-w {self.threads} "
                     f"-j {self.opts.pipeline}/merge_qc/{self.name}.json "
                     f"-h {self.opts.pipeline}/merge_qc/{self.name}.html "
                     f"--merged_out {self.merged} "
@@ -270,54 +620,160 @@ class ScrnaSample(Sample):
         self.fastq = opts.pipeline / f"{name}.umi_cell_labeled.fastq"
         self.barcode_fastq = self.fastq.with_suffix(".barcode.fastq")
         self.barcodes = opts.output / f"{name}.umi_cell_labeled.barcode.tsv"
-        self.steps = (self._sam_to_fastq, self._pysam_cutadapt, self._fast_to_tsv)
+        self.lineages = opts.output / (
+            f"{name}.cell_lineages.d{opts.cell_distance}.tsv"
+            if opts.cell_distance
+            else f"{name}.cell_lineages.tsv"
+        )
+        self.steps = (
+            self._sam_to_fastq,
+            self._pysam_cutadapt,
+            self._fast_to_tsv,
+            self._aggregate,
+        )
         super().__init__(name, opts)
 
     def check(self) -> Dict[str, bool]:
-        return {
-            f: getattr(self, f).is_file()
-            for f in ("fastq", "barcode_fastq", "barcodes")
-        }
+        exists = {}
+        # an output is only current if everything upstream of it is too
+        current = True
+        for name, step in (
+            ("fastq", "convert"),
+            ("barcode_fastq", "extract"),
+            ("barcodes", "tsv"),
+            ("lineages", "aggregate"),
+        ):
+            current = current and self.manifest.current(
+                step, getattr(self, name), self._fingerprint(step), quiet=True
+            )
+            exists[name] = current
+        return exists
+
+    def _fingerprint(self, step: str) -> Dict[str, Any]:
+        """fingerprint of the inputs, tools and options of a step"""
+        opts = self.opts
+        if step == "convert":
+            # reads are only prefiltered by the seeds of the adapters
+            prefilter = (
+                dict(
+                    upstream_adapter=opts.upstream_adapter,
+                    downstream_adapter=opts.downstream_adapter,
+                    error=opts.error,
+                )
+                if opts.prefilter
+                else {}
+            )
+            return fingerprint(
+                [self.sam] + ([opts.whitelist] if opts.whitelist else []),
+                ["pycashier"],
+                unmapped_only=opts.unmapped_only,
+                prefilter=prefilter,
+            )
+        elif step == "extract":
+            return fingerprint(
+                [self.fastq],
+                [cutadapt],
+                error=opts.error,
+                minimum_length=opts.minimum_length,
+                length=opts.length,
+                upstream_adapter=opts.upstream_adapter,
+                downstream_adapter=opts.downstream_adapter,
+                cutadapt_args=opts.cutadapt_args,
+            )
+        elif step == "tsv":
+            return fingerprint([self.barcode_fastq], ["pycashier"])
+        elif step == "aggregate":
+            return fingerprint(
+                [self.barcodes],
+                ["pycashier"],
+                cell_distance=opts.cell_distance,
+                ratio=opts.ratio,
+            )
+        raise ValueError(f"unknown step: {step}")
 
     @status_check
     def _sam_to_fastq(self) -> bool | None:
-        if not check_output(self.fastq, "converting sam to labeled fastq"):
-            return sam_to_name_labeled_fastq(self.name, self.sam, self.fastq)
+        from .scrna import (
+            AdapterPrefilter,
+            bam_to_name_labeled_fastq,
+            sam_to_name_labeled_fastq,
+        )
+
+        convert = (
+            bam_to_name_labeled_fastq
+            if self.sam.suffix == ".bam"
+            else sam_to_name_labeled_fastq
+        )
+        return self._run_step(
+            "convert",
+            self.fastq,
+            "converting sam to labeled fastq",
+            lambda output: convert(
+                self.name,
+                self.sam,
+                output,
+                self.threads,
+                unmapped_only=self.opts.unmapped_only,
+                whitelist=self.opts.whitelist,
+                prefilter=AdapterPrefilter(
+                    self.opts.upstream_adapter,
+                    self.opts.downstream_adapter,
+                    self.opts.error,
+                )
+                if self.opts.prefilter
+                else None,
+            ),
+        )
 
     @status_check
     def _pysam_cutadapt(
         self,
     ) -> bool | None:
-        """extract barcodes from single cell data
-
-        Args:
-           status: Rich.console status to suspend for stderr printing.
-        """
-        msg = "extracting barcodes with cutadapt"
+        """extract barcodes from single cell data"""
         adapter_string = (
             f"-g {self.opts.upstream_adapter} -a {self.opts.downstream_adapter}"
         )
 
-        if not check_output(self.barcode_fastq, msg):
+        def run(output: Path) -> bool | None:
             command = (
                 cutadapt
                 + " "
                 + (
                     f"-e {self.opts.error} "
-                    f"-j {self.opts.threads} "
+                    f"-j {self.threads} "
                     f"--minimum-length={self.opts.minimum_length} "
                     f"--maximum-length={self.opts.length} "
                     f"{adapter_string} "
                     f"{self.opts.cutadapt_args or ''} "
-                    f"-o {self.barcode_fastq} {self.fastq}"
+                    f"-o {output} {self.fastq}"
                 )
             )
-            with term.process(msg):
-                return run_cmd(
-                    command, self.name, self.barcode_fastq, self.opts.verbose
-                )
+            return run_cmd(command, self.name, output, self.opts.verbose)
+
+        return self._run_step(
+            "extract", self.barcode_fastq, "extracting barcodes with cutadapt", run
+        )
 
     @status_check
     def _fast_to_tsv(self) -> bool | None:
-        if not check_output(self.barcodes, "converting labeled fastq to tsv"):
-            return labeled_fastq_to_tsv(self.barcode_fastq, self.barcodes)
+        from .scrna import labeled_fastq_to_tsv
+
+        return self._run_step(
+            "tsv",
+            self.barcodes,
+            "converting labeled fastq to tsv",
+            lambda output: labeled_fastq_to_tsv(self.barcode_fastq, output),
+        )
+
+    @status_check
+    def _aggregate(self) -> bool | None:
+        from .scrna import aggregate_cells
+
+        return self._run_step(
+            "aggregate",
+            self.lineages,
+            "counting lineage UMIs per cell",
+            lambda output: aggregate_cells(
+                self.barcodes, output, self.opts.cell_distance, self.opts.ratio
+            ),
+        )
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional, Sequence
+
+from .lease import Leases
+from .sample import Sample, SampleStatus
+from .term import term
+
+
+def split_threads(threads: int, jobs: int, n_samples: int) -> tuple[int, int]:
+    """divide the global core budget between concurrent samples
+
+    Args:
+        threads: Total number of cpu cores available to pycashier.
+        jobs: Requested number of concurrent samples.
+        n_samples: Number of samples left to process.
+    Returns:
+        Number of concurrent samples and threads per sample.
+    """
+    jobs = max(1, min(jobs, n_samples))
+    if jobs > threads:
+        term.log.warning(
+            f"--jobs ({jobs}) exceeds --threads ({threads}), "
+            f"only running {threads} samples at a time"
+        )
+        jobs = threads
+    return jobs, max(1, threads // jobs)
+
+
+def run_sample(sample: Sample, leases: Optional[Leases] = None) -> bool:
+    """run the pipeline of a sample, claiming it first if the pipeline is shared
+
+    Args:
+        sample: Sample to process.
+        leases: Leases shared with other workers, if any.
+    Returns:
+        False if another worker holds the sample's lease.
+    """
+    if leases is None:
+        sample.pipeline()
+        return True
+
+    with leases.claim(sample.name) as lost:
+        if lost is None:
+            return False
+        sample.lost = lost
+        # another worker may have finished the sample since it was checked
+        if all(sample.recheck().values()):
+            term.log.info(f"{sample.name} was completed by another worker")
+            sample.status = SampleStatus.COMPLETE
+            sample.completed = True
+            return True
+        sample.pipeline()
+    return True
+
+
+def run_queue(
+    samples: Sequence[Sample], jobs: int, leases: Optional[Leases]
+) -> List[Sample]:
+    """run each sample once
+
+    Returns:
+        Samples skipped because another worker holds their lease.
+    """
+    if jobs == 1:
+        skipped = []
+        for sample in samples:
+            term.log.debug(f"starting sample: {sample.name}")
+            if not run_sample(sample, leases):
+                skipped.append(sample)
+        return skipped
+
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="sample") as pool:
+        futures = {}
+        for sample in samples:
+            term.log.debug(f"queueing sample: {sample.name}")
+            futures[pool.submit(run_sample, sample, leases)] = sample
+        # re-raise any unexpected exception from the sample's thread
+        return [futures[f] for f in as_completed(futures) if not f.result()]
+
+
+def run_samples(
+    samples: Sequence[Sample],
+    threads: int,
+    jobs: int,
+    leases: Optional[Leases] = None,
+) -> None:
+    """run the pipeline for each sample, several at a time if requested
+
+    Each sample runs in its own thread, the heavy lifting happens in
+    subprocesses or polars which release the GIL.
+    When sharing the pipeline, samples held by other workers are retried
+    until they're completed or their lease goes stale and can be broken.
+
+    Args:
+        samples: Samples to process.
+        threads: Total number of cpu cores available to pycashier.
+        jobs: Requested number of concurrent samples.
+        leases: Leases used to claim each sample from other workers.
+    """
+    if not samples:
+        return
+
+    jobs, sample_threads = split_threads(threads, jobs, len(samples))
+    if jobs > 1:
+        term.log.debug(
+            f"processing {jobs} samples concurrently with {sample_threads} threads each"
+        )
+        for sample in samples:
+            sample.threads = sample_threads
+
+    while skipped := run_queue(samples, jobs, leases):
+        assert leases is not None
+        term.log.info(
+            f"{len(skipped)} samples are claimed by other workers, "
+            f"checking them again in {leases.poll:.0f} seconds"
+        )
+        time.sleep(leases.poll)
+        samples = skipped
@@ -1,123 +1,607 @@
 from __future__ import annotations
 
+import gzip
+import os
+import resource
+import time
+from collections import Counter
+from contextlib import ExitStack
+from functools import partial
+from itertools import islice
+from multiprocessing import get_context
 from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
-import polars as pl
-from polars.exceptions import ComputeError, NoDataError
+from .metrics import RSS_UNIT, add_subprocess
+from .term import term
 
-try:
-    import pysam
-except ImportError:
-    pass
+# bytes of sam converted by each task
+CHUNK_SIZE = 32 * 2**20
+# smaller sam files are converted in-process, starting workers costs more than it saves
+PARALLEL_MIN_SIZE = 256 * 2**20
+# quality of reads stored without one ("*"), the highest phred+33 score of illumina
+MISSING_QUALITY = b"I"
+# sam flag of unmapped reads
+UNMAPPED = 0x4
+# bam records converted between updates of the progress bar
+PROGRESS_INTERVAL = 10_000
+# largest whitelist whose hamming neighbors are indexed up front
+NEIGHBOR_INDEX_LIMIT = 100_000
 
-from rich.progress import Progress, SpinnerColumn, TimeElapsedColumn
 
-from .term import term
+def sam_chunks(sam_file: Path, chunk_size: int = CHUNK_SIZE) -> List[Tuple[int, int]]:
+    """split the records of a sam file into byte ranges starting on a new line
+
+    Args:
+        sam_file: Sam file to split.
+        chunk_size: Approximate size of each range.
+    Returns:
+        Start and end offsets of each range.
+    """
+    size = sam_file.stat().st_size
+    with sam_file.open("rb") as f:
+        # skip the header
+        while (line := f.readline()).startswith(b"@"):
+            pass
+        boundaries = [f.tell() - len(line)]
+        while boundaries[-1] + chunk_size < size:
+            f.seek(boundaries[-1] + chunk_size)
+            f.readline()
+            if (offset := f.tell()) >= size:
+                break
+            boundaries.append(offset)
+    boundaries.append(size)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+class CellWhitelist:
+    """called cell barcodes with correction of single mismatches
+
+    Barcodes within a hamming distance of one of exactly one whitelisted
+    barcode are corrected to it. For whitelists of up to `NEIGHBOR_INDEX_LIMIT`
+    barcodes, like the filtered barcodes of a sample, every neighbor is indexed
+    up front. The full 10x whitelists would need hundreds of millions of entries,
+    so the neighbors of each uncorrected barcode are looked up instead.
+
+    Args:
+        barcodes: Cell barcodes without the gem group suffix, i.e. `-1`.
+    """
+
+    def __init__(self, barcodes: Iterable[bytes]) -> None:
+        self.barcodes = frozenset(barcodes)
+        self.neighbors: Optional[Dict[bytes, Optional[bytes]]] = None
+        if len(self.barcodes) <= NEIGHBOR_INDEX_LIMIT:
+            self.neighbors = {}
+            for barcode in self.barcodes:
+                for neighbor in hamming_neighbors(barcode):
+                    # neighbors of several barcodes are ambiguous
+                    self.neighbors[neighbor] = (
+                        None if neighbor in self.neighbors else barcode
+                    )
+
+    @classmethod
+    def read(cls, path: Path) -> CellWhitelist:
+        """read a whitelist with one barcode per line, may be gzipped
+
+        Args:
+            path: Whitelist such as cellranger's `barcodes.tsv.gz`.
+        """
+        with (gzip.open if path.name.endswith(".gz") else open)(path, "rb") as f:
+            return cls(
+                barcode
+                for line in f
+                if (barcode := line.split(b"\t")[0].strip().split(b"-")[0])
+            )
+
+    def __len__(self) -> int:
+        return len(self.barcodes)
+
+    def correct(self, barcode: bytes) -> Optional[bytes]:
+        """whitelisted barcode matching `barcode`, None if there is no unique match"""
+        if barcode in self.barcodes:
+            return barcode
+        if self.neighbors is not None:
+            return self.neighbors.get(barcode)
+        matches = {n for n in hamming_neighbors(barcode) if n in self.barcodes}
+        return matches.pop() if len(matches) == 1 else None
+
+
+def hamming_neighbors(barcode: bytes) -> Iterator[bytes]:
+    """every sequence with a single substitution, including Ns"""
+    for i, base in enumerate(barcode):
+        for other in b"ACGTN":
+            if other != base:
+                yield barcode[:i] + bytes((other,)) + barcode[i + 1 :]
+
+
+class AdapterPrefilter:
+    """fast check for reads that may contain either adapter
+
+    Uses the pigeonhole seeds of the native extraction engine, a read with
+    a match of an adapter within the error rate, including partial matches
+    at the ends of the read, contains at least one seed exactly.
+
+    Args:
+        upstream: 5' adapter.
+        downstream: 3' adapter.
+        error: Maximum error rate.
+    """
+
+    def __init__(self, upstream: str, downstream: str, error: float) -> None:
+        from .extract import _regions
+
+        self.regions = [
+            (front, size, [kmer.encode() for kmer in kmers])
+            for front, adapter in ((True, upstream), (False, downstream))
+            for size, kmers in _regions(adapter.upper(), error, front)
+        ]
+
+    def __call__(self, seq: bytes) -> bool:
+        for front, size, kmers in self.regions:
+            region = seq if size is None else seq[:size] if front else seq[-size:]
+            if any(kmer in region for kmer in kmers):
+                return True
+        return False
+
+
+def convert_sam_records(
+    lines: Iterable[bytes],
+    counts: Counter,
+    unmapped_only: bool = False,
+    whitelist: Optional[CellWhitelist] = None,
+    prefilter: Optional[AdapterPrefilter] = None,
+) -> bytes:
+    """convert sam records to metadata labeled fastq records
+
+    Records without a cell barcode or UMI are skipped, as well as records
+    from cells missing from `whitelist`. Corrected barcodes (CB) are
+    trusted, raw barcodes (CR) are corrected against the whitelist.
+
+    Args:
+        lines: Sam records.
+        counts: Counter of records, kept, untagged, uncalled,
+            corrected and prefiltered reads.
+        unmapped_only: Skip mapped records.
+        whitelist: Called cell barcodes.
+        prefilter: Skip reads without a seed of either adapter.
+    Returns:
+        Fastq records with read names as `<read>_<umi>_<cell>`.
+    """
+    fastq = []
+    records = untagged = uncalled = corrected = prefiltered = 0
+    for line in lines:
+        fields = line.split(b"\t")
+        if len(fields) < 11 or fields[9] == b"*":
+            continue
+        if unmapped_only and not int(fields[1]) & UNMAPPED:
+            continue
+        records += 1
+        tags = {tag[:2]: tag[5:] for tag in fields[11:]}
+        cell_barcode: Optional[bytes]
+        if b"CB" in tags:
+            cell_barcode = tags[b"CB"].split(b"-")[0]
+        else:
+            cell_barcode = tags.get(b"CR")
+        umi = tags.get(b"UB") or tags.get(b"UR")
+        if not (cell_barcode and umi):
+            untagged += 1
+            continue
+        if whitelist is not None:
+            if b"CB" in tags:
+                called = cell_barcode if cell_barcode in whitelist.barcodes else None
+            else:
+                called = whitelist.correct(cell_barcode)
+                corrected += called is not None and called != cell_barcode
+            if called is None:
+                uncalled += 1
+                continue
+            cell_barcode = called
+        if prefilter is not None and not prefilter(fields[9]):
+            prefiltered += 1
+            continue
+        # sam qualities are already phred+33
+        qual = fields[10] if fields[10] != b"*" else MISSING_QUALITY * len(fields[9])
+        fastq.append(
+            b"@%s_%s_%s\n%s\n+\n%s\n" % (fields[0], umi, cell_barcode, fields[9], qual)
+        )
+    counts.update(
+        records=records,
+        kept=len(fastq),
+        untagged=untagged,
+        uncalled=uncalled,
+        corrected=corrected,
+        prefiltered=prefiltered,
+    )
+    return b"".join(fastq)
+
+
+def convert_sam_chunk(
+    sam_file: Path,
+    start: int,
+    end: int,
+    unmapped_only: bool = False,
+    whitelist: Optional[CellWhitelist] = None,
+    prefilter: Optional[AdapterPrefilter] = None,
+) -> Tuple[bytes, Counter]:
+    """convert a byte range of a sam file with `convert_sam_records`
+
+    Args:
+        sam_file: Sam file to read.
+        start: Offset of the first record.
+        end: Offset after the last record.
+        unmapped_only: Skip mapped records.
+        whitelist: Called cell barcodes.
+        prefilter: Skip reads without a seed of either adapter.
+    Returns:
+        Fastq records and counts of converted reads.
+    """
+    with sam_file.open("rb") as f:
+        f.seek(start)
+        lines = f.read(end - start).splitlines()
+    counts: Counter = Counter()
+    fastq = convert_sam_records(lines, counts, unmapped_only, whitelist, prefilter)
+    return fastq, counts
+
+
+# options set once by each worker process rather than sent with every chunk
+_options: Dict[str, Any] = {}
+# pid, user and system cpu seconds and peak memory of a worker process
+WorkerUsage = Tuple[int, float, float, int]
+
+
+def _init_worker(
+    unmapped_only: bool,
+    whitelist_file: Optional[Path],
+    prefilter: Optional[AdapterPrefilter],
+) -> None:
+    _options.update(
+        unmapped_only=unmapped_only,
+        whitelist=CellWhitelist.read(whitelist_file) if whitelist_file else None,
+        prefilter=prefilter,
+    )
+
+
+def _convert_sam_chunk(
+    args: Tuple[Path, int, int], **options: Any
+) -> Tuple[int, bytes, Counter, WorkerUsage]:
+    """convert a chunk, in a worker with the options set by `_init_worker`
+
+    Returns:
+        Size of the chunk, fastq records, counts of converted reads
+        and the usage of the process so far, which is only meaningful in a worker.
+    """
+    sam_file, start, end = args
+    fastq, counts = convert_sam_chunk(sam_file, start, end, **(options or _options))
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return (
+        end - start,
+        fastq,
+        counts,
+        (os.getpid(), usage.ru_utime, usage.ru_stime, usage.ru_maxrss * RSS_UNIT),
+    )
+
+
+class ConversionStats:
+    """reads converted to fastq, shown with the progress of the sample
+
+    Args:
+        description: Task description.
+        advance: Callable updating the progress bar.
+    """
+
+    def __init__(self, description: str, advance: Callable[..., None]) -> None:
+        self.description = description
+        self._advance = advance
+        self.start = time.perf_counter()
+        self.counts: Counter = Counter()
+
+    def update(self, counts: Counter, **kwargs: Any) -> None:
+        """count converted reads and move the progress bar
+
+        Args:
+            counts: Counts from `convert_sam_records`.
+            **kwargs: Passed on to the progress bar (advance/completed).
+        """
+        self.counts.update(counts)
+        records, kept = self.counts["records"], self.counts["kept"]
+        rate = records / max(time.perf_counter() - self.start, 1e-9)
+        self._advance(
+            description=f"{self.description} [dim]{rate:,.0f} reads/s, "
+            f"kept {kept:,}, skipped {records - kept:,}",
+            **kwargs,
+        )
+
+    def log(self, file: Path) -> None:
+        counts = self.counts
+        msg = (
+            f"{file.name}: kept {counts['kept']:,} of {counts['records']:,} reads, "
+            f"skipped {counts['untagged']:,} without cell barcode and UMI tags"
+        )
+        if counts["uncalled"] or counts["corrected"]:
+            msg += (
+                f", {counts['uncalled']:,} from cells missing from the whitelist "
+                f"and corrected {counts['corrected']:,} cell barcodes"
+            )
+        if counts["prefiltered"]:
+            msg += f", discarded {counts['prefiltered']:,} without either adapter"
+        term.log.info(msg)
 
 
-# pysam types are finicky
 def sam_to_name_labeled_fastq(
-    sample: str, sam_file: Path, out_file: Path
+    sample: str,
+    sam_file: Path,
+    out_file: Path,
+    threads: int = 1,
+    unmapped_only: bool = False,
+    whitelist: Optional[Path] = None,
+    prefilter: Optional[AdapterPrefilter] = None,
 ) -> bool | None:
     """convert sam file to metadata labeled fastq
 
+    Sam files of at least `PARALLEL_MIN_SIZE` bytes are split into byte ranges
+    converted by `threads` worker processes, their outputs are written
+    in the order of the input.
+    Progress is measured in bytes, so the file is only read once.
+
     Args:
         sample: Name of sample.
         sam_file: Sam file to convert.
         out_file: Converted fastq file.
-        status: Rich.console status to suspend for stderr printing.
+        threads: Number of processes.
+        unmapped_only: Skip mapped records.
+        whitelist: File of called cell barcodes, reads from other cells are skipped.
+        prefilter: Skip reads without a seed of either adapter.
+    """
+
+    try:
+        chunks = [
+            (sam_file, start, end) for start, end in sam_chunks(sam_file, CHUNK_SIZE)
+        ]
+        parallel = (
+            threads > 1
+            and len(chunks) > 1
+            and sam_file.stat().st_size >= PARALLEL_MIN_SIZE
+        )
+    except OSError as e:
+        term.log.error(f"Couldn't load sam file:{sam_file}. {e}")
+        return True
+
+    converted: Iterator[Tuple[int, bytes, Counter, WorkerUsage]]
+    workers: Dict[int, WorkerUsage] = {}
+    with ExitStack() as stack:
+        if parallel:
+            pool = stack.enter_context(
+                # forking a process running threads is unsafe
+                get_context("spawn").Pool(
+                    min(threads, len(chunks)),
+                    initializer=_init_worker,
+                    initargs=(unmapped_only, whitelist, prefilter),
+                )
+            )
+            converted = pool.imap(_convert_sam_chunk, chunks)
+        else:
+            converted = map(
+                partial(
+                    _convert_sam_chunk,
+                    unmapped_only=unmapped_only,
+                    whitelist=CellWhitelist.read(whitelist) if whitelist else None,
+                    prefilter=prefilter,
+                ),
+                chunks,
+            )
+
+        f_out = stack.enter_context(out_file.open("wb"))
+        stats = ConversionStats(
+            "sam -> fastq",
+            stack.enter_context(
+                term.progress(
+                    "sam -> fastq",
+                    total=sum(end - start for _, start, end in chunks),
+                    unit="B",
+                )
+            ),
+        )
+        try:
+            for size, fastq, counts, usage in converted:
+                f_out.write(fastq)
+                stats.update(counts, advance=size)
+                if parallel:
+                    workers[usage[0]] = usage
+        # raised by the chunk of a malformed record, in a worker or this process
+        except (ValueError, IndexError):
+            term.log.error(
+                f"Couldn't load sam file:{sam_file}. Is it the correct format?"
+            )
+            return True
+    # usage of workers isn't seen by the sample's thread
+    for _, user, system, max_rss in workers.values():
+        add_subprocess("sam-worker", user, system, max_rss)
+    stats.log(sam_file)
+
+
+def bam_to_name_labeled_fastq(
+    sample: str,
+    bam_file: Path,
+    out_file: Path,
+    threads: int = 1,
+    unmapped_only: bool = False,
+    whitelist: Optional[Path] = None,
+    prefilter: Optional[AdapterPrefilter] = None,
+) -> bool | None:
+    """convert bam file to metadata labeled fastq
+
+    Blocks are decompressed by `threads` threads. With `unmapped_only` and an index,
+    only the unplaced unmapped reads at the end of a sorted bam are read.
+    Progress is measured by the compressed offset of the current block.
+
+    Args:
+        sample: Name of sample.
+        bam_file: Bam file to convert.
+        out_file: Converted fastq file.
+        threads: Number of decompression threads.
+        unmapped_only: Skip mapped records.
+        whitelist: File of called cell barcodes, reads from other cells are skipped.
+        prefilter: Skip reads without a seed of either adapter.
     """
+    import pysam
 
-    # if the file is a sam file this is the only way I can find in the
-    # pysam API to get the total number of reads
-    # we really only need this for the progess bar though
     try:
-        with pysam.AlignmentFile(  # type: ignore
-            str(sam_file.absolute()),
-            "r",
-            check_sq=False,
-            check_header=False,
-        ) as sam:
-            with term.process("getting sam size"):
-                sam_length = sam.count()
-    except ValueError:
-        term.log.error(f"Couldn't load sam file:{sam_file}. Is it the correct format?")
+        bam = pysam.AlignmentFile(str(bam_file), "rb", check_sq=False, threads=threads)
+    except (OSError, ValueError) as e:
+        term.log.error(f"Couldn't load bam file:{bam_file}. {e}")
         return True
 
-    # we don't care about indicies or genomes. since cutadapt will do the heavy lifting here
-    with open(out_file, "w") as f_out, pysam.AlignmentFile(
-        str(sam_file.absolute()),
-        "r",
-        check_sq=False,
-        check_header=False,  # type: ignore
-    ) as sam:
-        with term._no_status(), Progress(
-            SpinnerColumn("point", style="bright_magenta"),
-            *Progress.get_default_columns(),
-            "Elapsed:",
-            TimeElapsedColumn(),
-            transient=True,
-            console=term._console,
-        ) as progress:
-            task = progress.add_task("sam -> fastq", total=sam_length)
-
-            for record in sam.fetch(until_eof=True):
-                tagdict = dict(record.tags)  # type: ignore
-                cell_barcode = None
-                if "CB" in tagdict.keys():
-                    cell_barcode = tagdict["CB"].split("-")[0]
-                elif "CR" in tagdict.keys():
-                    cell_barcode = tagdict["CR"]
-
-                umi = None
-                if "UB" in tagdict.keys():
-                    umi = tagdict["UB"]
-                elif "UR" in tagdict.keys():
-                    umi = tagdict["UR"]
-
-                if cell_barcode and umi:
-                    qualities = record.query_qualities
-                    ascii_qualities = "".join([chr(q + 33) for q in qualities])  # type: ignore
-
-                    f_out.write(f"@{record.query_name}_{umi}_{cell_barcode}\n")
-                    f_out.write(f"{record.query_sequence}\n+\n{ascii_qualities}\n")
-
-                progress.advance(task)
+    cells = CellWhitelist.read(whitelist) if whitelist else None
+    with ExitStack() as stack:
+        stack.enter_context(bam)
+        if unmapped_only and bam.has_index():
+            records = bam.fetch("*")
+        else:
+            if unmapped_only:
+                term.log.warning(
+                    f"no index found for {bam_file}, reading every record to find unmapped reads"
+                )
+            records = bam.fetch(until_eof=True)
+
+        f_out = stack.enter_context(out_file.open("wb"))
+        stats = ConversionStats(
+            "bam -> fastq",
+            stack.enter_context(
+                term.progress("bam -> fastq", total=bam_file.stat().st_size, unit="B")
+            ),
+        )
+        # records are converted as sam in batches between updates of the progress bar
+        while batch := [
+            record.to_string().encode() for record in islice(records, PROGRESS_INTERVAL)
+        ]:
+            counts: Counter = Counter()
+            f_out.write(
+                convert_sam_records(batch, counts, unmapped_only, cells, prefilter)
+            )
+            # upper bits of a virtual offset are the compressed block offset
+            stats.update(counts, completed=bam.tell() >> 16)
+        stats.update(Counter(), completed=bam_file.stat().st_size)
+    stats.log(bam_file)
 
 
 def labeled_fastq_to_tsv(in_file: Path, out_file: Path) -> bool | None:
     """convert labeled fastq to tsv
 
+    Records are converted in batches, so memory doesn't grow with the number of reads.
+
     Args:
         in_file: Fastq to convert to tsv.
         out_file: Converted tsv file.
     Return:
         1 if failure
     """
+    import polars as pl
+
+    from .fastq import FastqError, open_fastq, read_fastq
+
+    header = True
     try:
-        (
-            pl.scan_csv(in_file, has_header=False, separator="\t")
-            .select(
-                pl.all()
-                .gather_every(4)
-                .str.splitn("_", 3)
-                .struct.rename_fields(["info", "umi", "cell"])
-                .alias("info"),
-                pl.all().gather_every(4, offset=1).alias("barcode"),
-            )
-            .unnest("info")
-            .collect()
-            .write_csv(out_file, separator="\t")
-        )
-    except ComputeError:
+        with open_fastq(in_file) as reads, out_file.open("w") as f:
+            for batch in read_fastq(reads, fields=("name", "seq")):
+                batch.select(
+                    pl.concat_str(pl.lit("@"), "name")
+                    .str.splitn("_", 3)
+                    .struct.rename_fields(["info", "umi", "cell"])
+                    .alias("info"),
+                    barcode="seq",
+                ).unnest("info").write_csv(f, separator="\t", include_header=header)
+                header = False
+    except FastqError as e:
         term.log.error(
-            f"failed to convert fastq to tsv: {in_file}\n"
+            f"failed to convert fastq to tsv: {in_file}\n{e}, "
             "ensure fastq was not corrupted and contains all reads"
         )
         return True
-    except NoDataError:
+    if header:
         term.log.error(
             f"failed to convert fastq to tsv: {in_file}\n"
             "no reads found, check cutadapt output"
         )
         return True
+
+
+def aggregate_cells(
+    in_file: Path, out_file: Path, distance: int = 0, ratio: float = 3.0
+) -> bool | None:
+    """count the UMIs of each barcode within each cell
+
+    Reads are collapsed to unique cell, UMI and barcode triples, which are then
+    counted per cell and barcode. Both steps run on polars' streaming engine,
+    so the labeled reads don't need to fit in memory.
+
+    Args:
+        in_file: Tsv of labeled reads from `labeled_fastq_to_tsv`.
+        out_file: Tsv of cell, barcode, umis and reads sorted by cell and umis.
+        distance: Levenshtein distance to cluster barcodes within each cell, 0 to skip.
+        ratio: Minimum ratio of parent to child UMI counts when clustering.
+    """
+    import polars as pl
+    from polars.exceptions import ComputeError, NoDataError
+
+    from .cluster import find_parents, message_passing
+
+    def count(triples: pl.LazyFrame) -> pl.LazyFrame:
+        return (
+            triples.group_by("cell", "barcode")
+            .agg(umis=pl.len(), reads=pl.col("reads").sum())
+            .sort(["cell", "umis", "barcode"], descending=[False, True, False])
+        )
+
+    try:
+        triples = (
+            pl.scan_csv(
+                in_file,
+                separator="\t",
+                schema_overrides={c: pl.String for c in ("umi", "cell", "barcode")},
+            )
+            .group_by("cell", "umi", "barcode")
+            .agg(reads=pl.len())
+        )
+        count(triples).sink_csv(out_file, separator="\t")
+        if not distance:
+            return None
+
+        # counts per cell are far smaller than the reads, cluster them in memory
+        counts = (
+            pl.read_csv(
+                out_file,
+                separator="\t",
+                schema_overrides={"cell": pl.String, "barcode": pl.String},
+            )
+            .rename({"umis": "count"})
+            .with_row_index("id")
+        )
+    except (ComputeError, NoDataError):
+        term.log.error(
+            f"failed to aggregate cells: {in_file}\n"
+            "ensure the tsv was not corrupted and contains reads"
+        )
+        return True
+
+    canonical = message_passing(counts, find_parents(counts, distance, ratio, ["cell"]))
+    barcodes = counts.get_column("barcode")
+    mapping = counts.select("cell", "barcode").with_columns(
+        canonical=pl.Series(
+            [
+                barcodes[canonical[id_]] if id_ in canonical else None
+                for id_ in counts.get_column("id")
+            ],
+            dtype=pl.String,
+        )
+    )
+    term.log.debug(
+        f"clustered {counts.height} cell barcodes into "
+        f"{len(set(canonical.values()))} clusters, "
+        f"{counts.height - len(canonical)} ambiguous"
+    )
+    # recount UMIs as the same UMI may be seen with several barcodes of a cluster
+    count(
+        triples.join(mapping.drop_nulls().lazy(), on=["cell", "barcode"])
+        .group_by("cell", "umi", barcode="canonical")
+        .agg(pl.col("reads").sum())
+    ).sink_csv(out_file, separator="\t")
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import json
+import os
+import socket
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+from .manifest import partial_path
+from .term import term
+
+# directories modified this recently may hide a rename made in the same mtime tick
+RACY_NS = 2 * 10**9
+
+
+def stat_key(path: Path) -> Optional[List[int]]:
+    """size and modification time of a file or directory, None if missing"""
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class StateIndex:
+    """cached results of checking each sample's pipeline outputs
+
+    Stored as json in `<pipeline>/state/index.json`. An entry is reused while
+    its options are unchanged and none of the files it was derived from
+    were modified. Outputs are written by renaming a temporary file, which
+    updates the modification time of their directory, so while the watched
+    directories are unchanged only each sample's inputs need to be stat'ed.
+
+    Args:
+        pipeline: Pipeline directory.
+        dirs: Directories outputs are written to.
+    """
+
+    def __init__(self, pipeline: Path, dirs: Sequence[Path]) -> None:
+        self.path = pipeline / "state" / "index.json"
+        self.dirs = {str(d): stat_key(d) for d in dirs}
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.unchanged = False
+        self.modified = False
+        if self.path.is_file():
+            try:
+                state = json.loads(self.path.read_text())
+            except json.JSONDecodeError:
+                term.log.warning(f"ignoring unreadable state index: {self.path}")
+            else:
+                self.entries = state["samples"]
+                self.unchanged = None not in state["dirs"].values() and (
+                    state["dirs"] == self.dirs
+                )
+
+    def get(
+        self, name: str, key: Dict[str, Any], inputs: Sequence[Path]
+    ) -> Optional[Dict[str, Any]]:
+        """cached values for a sample if they are still valid
+
+        Args:
+            name: Sample name.
+            key: Options the values depend on.
+            inputs: Input files of the sample, always checked.
+        Returns:
+            Cached values or None.
+        """
+        if not (entry := self.entries.get(name)) or entry["key"] != key:
+            return None
+        files = entry["files"]
+        paths = inputs if self.unchanged else [Path(f) for f in files]
+        if any(stat_key(f) != files.get(str(f)) for f in paths):
+            return None
+        values: Dict[str, Any] = entry["values"]
+        return values
+
+    def set(
+        self, name: str, key: Dict[str, Any], files: Sequence[Path], **values: Any
+    ) -> None:
+        """cache values for a sample
+
+        Args:
+            name: Sample name.
+            key: Options the values depend on.
+            files: Every file the values were derived from.
+            **values: Json serializable values.
+        """
+        self.entries[name] = {
+            "key": key,
+            "files": {str(f): stat_key(f) for f in files},
+            "values": values,
+        }
+        self.modified = True
+
+    def save(self) -> None:
+        if not self.modified and self.unchanged:
+            return
+        now = time.time_ns()
+        dirs = {
+            # a racy directory is checked file by file on the next run
+            d: key if key and now - key[1] > RACY_NS else None
+            for d, key in self.dirs.items()
+        }
+        self.path.parent.mkdir(exist_ok=True)
+        # unique, as workers sharing the pipeline with --claim may save at once
+        tmp = partial_path(self.path).with_suffix(
+            f".{socket.gethostname()}.{os.getpid()}"
+        )
+        tmp.write_text(json.dumps({"dirs": dirs, "samples": self.entries}))
+        tmp.replace(self.path)
+        self.modified = False
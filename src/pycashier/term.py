@@ -3,22 +3,45 @@ from __future__ import annotations
 import logging
 import shutil
 import sys
-from contextlib import contextmanager
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack, contextmanager
+from datetime import timedelta
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
 from textwrap import dedent
-from typing import Any, Generator, Optional
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Generator,
+    List,
+    NoReturn,
+    Optional,
+    Tuple,
+)
 
+from rich import filesize
 from rich.console import Console
 from rich.highlighter import NullHighlighter, RegexHighlighter
+from rich.live import Live
 from rich.logging import RichHandler
 from rich.panel import Panel
 from rich.prompt import Confirm
-from rich.status import Status
+from rich.spinner import Spinner
+from rich.table import Table
 from rich.text import Text
 from rich.theme import Theme
 
 MAX_WIDTH = 110
+# redraws of the live display per second, updates in between only record progress
+REFRESH_PER_SECOND = 4
+# seconds between progress reports written to the log
+REPORT_INTERVAL = 30
+# recent samples of each step's progress its rate is calculated from
+RATE_SAMPLES = 4 * REFRESH_PER_SECOND
 
 theme = Theme(
     {
@@ -43,7 +66,7 @@ class StreamFormatter(logging.Formatter):
         super().__init__()
         self.FORMATS = {
             **{
-                level: (f"[{color}]%(levelname)-7s[/]" " %(message)s")
+                level: (f"[{color}]%(levelname)-7s[/] %(message)s")
                 for level, color in {
                     logging.DEBUG: "dim",
                     logging.WARNING: "yellow",
@@ -89,14 +112,107 @@ class ErrorHighlighter(RegexHighlighter):
     highlights = [r"(?P<error>\[\w+Error\])"]
 
 
+class SampleProgress:
+    """progress of the step a sample is running, one row of the live display
+
+    Progress is either reported through `update` or, for subprocesses,
+    measured from the growth of the file they are writing.
+    Nothing is computed on update, rates are sampled when the row is rendered.
+
+    Args:
+        name: Sample name.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.spinner = Spinner("point", style="bright_magenta")
+        self.step()
+
+    def step(self, msg: str = "") -> None:
+        """start a new step, resetting its progress"""
+        self.msg = msg
+        self.reset()
+
+    def reset(
+        self,
+        description: str = "",
+        total: Optional[float] = None,
+        unit: str = "",
+        watch: Optional[Path] = None,
+    ) -> None:
+        self.description = description
+        self.total = total
+        self.unit = unit
+        self.watch = watch
+        self.completed = 0.0
+        self.started = time.monotonic()
+        self._samples: Deque[Tuple[float, float]] = deque(maxlen=RATE_SAMPLES)
+
+    def update(
+        self,
+        advance: float = 0,
+        completed: Optional[float] = None,
+        total: Optional[float] = None,
+        description: Optional[str] = None,
+    ) -> None:
+        if completed is not None:
+            self.completed = completed
+        self.completed += advance
+        if total is not None:
+            self.total = total
+        if description is not None:
+            self.description = description
+
+    def _poll(self) -> Optional[float]:
+        """record how much is completed and return the recent rate"""
+        if self.watch:
+            try:
+                self.completed = self.watch.stat().st_size
+            except FileNotFoundError:
+                pass
+        now = time.monotonic()
+        self._samples.append((now, self.completed))
+        (start, first), (end, last) = self._samples[0], self._samples[-1]
+        if end - start < 1:
+            # too soon for the rate of the recent samples to be meaningful
+            if now - self.started < 1:
+                return None
+            start, first = self.started, 0.0
+        return (last - first) / (end - start)
+
+    def _amount(self, n: float) -> str:
+        if self.unit == "B":
+            return filesize.decimal(int(n))
+        if self.unit == "%":
+            return f"{n:.0f}%"
+        return f"{n:,.0f} {self.unit}".rstrip()
+
+    def fields(self) -> List[str]:
+        """step, processed, rate, eta and elapsed time formatted for display"""
+        rate = self._poll()
+        processed = rate_text = eta = ""
+        if self.unit or self.watch:
+            processed = self._amount(self.completed)
+            if self.total and self.unit not in ("%", "B"):
+                processed = f"{self.completed:,.0f}/{self._amount(self.total)}"
+            elif self.total and self.unit == "B":
+                processed += f"/{self._amount(self.total)}"
+        if rate is not None and processed:
+            rate_text = self._amount(rate) + "/s"
+            if self.total and rate > 0:
+                remaining = max(self.total - self.completed, 0) / rate
+                eta = "eta " + str(timedelta(seconds=int(remaining)))
+        elapsed = str(timedelta(seconds=int(time.monotonic() - self.started)))
+        step = " ".join(filter(None, (self.msg, self.description)))
+        return [step, processed, rate_text, eta, elapsed]
+
+
 class Term:
     """rich-based ui"""
 
-    _status_name: str | None = None
-    _status: Status | None = None
+    _live: Live | None = None
 
     def __init__(self, width: Optional[int] = None) -> None:
-        self._process_msg = "default msg"
         self._console = Console(highlight=False, theme=theme, width=width)
         self._err_console = Console(
             theme=Theme({"hl": "bold cyan", "error": "bold red"}, inherit=True),
@@ -104,6 +220,18 @@ class Term:
             highlighter=ErrorHighlighter(),
             width=width,
         )
+        # progress keyed by the name passed to cash_in,
+        # several samples may be in flight at once (see scheduler.py)
+        self._active: Dict[str, SampleProgress] = {}
+        self._lock = threading.RLock()
+        # serializes starting/stopping the live display, it may be taken before
+        # `_lock` but never while holding it, since the live display's refresh
+        # thread holds its own lock while rendering
+        self._display_lock = threading.RLock()
+        self._local = threading.local()
+        self._paused = 0
+        self._reporter: Optional[Tuple[threading.Thread, threading.Event]] = None
+        self._verbose = False
 
     # use property ?
     def set_logger(self, log_file: Path, verbose: bool) -> None:
@@ -133,45 +261,122 @@ class Term:
         fh.setLevel(logging.DEBUG)
         fh.setFormatter(FileFormatter("%(asctime)s | %(levelname)8s | %(message)s"))
 
+        # replace handlers from any previous invocation in the same process
+        for handler in logger.handlers[:]:
+            logger.removeHandler(handler)
+            handler.close()
         logger.addHandler(ch)
         logger.addHandler(fh)
         self.log = logging.getLogger("pycashier")
+        self._verbose = verbose
 
     @contextmanager
     def _no_status(self) -> Generator[None, None, None]:
+        with self._display_lock:
+            if self._paused == 0 and (live := self._live):
+                live.stop()
+            self._paused += 1
         try:
-            if status := getattr(self, "_status", None):
-                status.stop()
             yield
         finally:
-            if status:
-                status.start()
+            with self._display_lock:
+                self._paused -= 1
+                if self._paused == 0 and (live := self._live):
+                    live.start()
 
     def print(self, *args: Any, err: bool = False, **kwargs: Any) -> None:
         console = self._err_console if err else self._console
         with self._no_status():
             console.print(*args, **kwargs)
 
-    def quit(self, code: int = 1) -> None:
-        if status := getattr(self, "_status", None):
-            status.stop()
+    def quit(self, code: int = 1) -> NoReturn:
+        self._stop_display()
         self._err_console.print("Exiting.")
         sys.exit(code)
 
+    def _render(self) -> Table:
+        """table of in-flight samples, called by the live display as it refreshes"""
+        table = Table.grid(padding=(0, 1))
+        # a snapshot without taking `_lock`, see `_display_lock`
+        for row in tuple(self._active.values()):
+            step, *numbers = row.fields()
+            table.add_row(row.spinner, row.name, f"[dim]{step}", *numbers)
+        return table
+
+    def _report(self, level: int, stop: threading.Event) -> None:
+        """periodically log the progress of in-flight samples as text"""
+        while not stop.wait(REPORT_INTERVAL):
+            if log := getattr(self, "log", None):
+                for row in tuple(self._active.values()):
+                    log.log(
+                        level, row.name + ": " + " ".join(filter(None, row.fields()))
+                    )
+
+    def _start_display(self) -> None:
+        # the live display is only useful on a terminal,
+        # otherwise (and with --verbose) progress is logged periodically instead
+        self._stop_display()
+        if self._console.is_terminal:
+            self._live = Live(
+                console=self._console,
+                get_renderable=self._render,
+                refresh_per_second=REFRESH_PER_SECOND,
+                transient=True,
+            )
+            if not self._paused:
+                self._live.start()
+        if not self._console.is_terminal or self._verbose:
+            stop = threading.Event()
+            reporter = threading.Thread(
+                target=self._report,
+                args=(
+                    logging.INFO if not self._console.is_terminal else logging.DEBUG,
+                    stop,
+                ),
+                name="progress-reporter",
+                daemon=True,
+            )
+            reporter.start()
+            self._reporter = (reporter, stop)
+
+    def _stop_display(self) -> None:
+        with self._display_lock:
+            if live := self._live:
+                live.stop()
+                self._live = None
+            if self._reporter:
+                reporter, stop = self._reporter
+                stop.set()
+                reporter.join()
+                self._reporter = None
+
+    def _current(self) -> Optional[SampleProgress]:
+        """progress of the sample cashed in by this thread"""
+        name = getattr(self._local, "name", None)
+        if name is None and self._active:
+            name = next(iter(self._active))
+        return self._active.get(name) if name is not None else None
+
     @contextmanager
-    def cash_in(self, name: str) -> Generator[Status, None, None]:
+    def cash_in(self, name: str) -> Generator[SampleProgress, None, None]:
+        """show a row for `name` in the live display while it's processed"""
+        with self._display_lock:
+            with self._lock:
+                row = self._active[name] = SampleProgress(name)
+                self._local.name = name
+                first = len(self._active) == 1
+            if first:
+                self._start_display()
         try:
-            self._status_name = name
-            self._status = self._console.status(
-                name, spinner="point", spinner_style="bright_magenta"
-            )
-            self._status.start()
-            yield self._status
+            yield row
         finally:
-            if self._status:
-                self._status.stop()
-            self._status_name = None
-            self._status = None
+            with self._display_lock:
+                with self._lock:
+                    self._active.pop(name, None)
+                    self._local.name = None
+                    last = not self._active
+                if last:
+                    self._stop_display()
 
     def mode(self, cmd: str) -> None:
         term.log.info(f"[bold]pycashier [green]{cmd}")
@@ -193,15 +398,49 @@ class Term:
 
     @contextmanager
     def process(self, msg: str = "") -> Generator[None, None, None]:
-        name = getattr(self, "_status_name")
-        status = getattr(self, "_status")
-        if msg:
-            msg = " [dim]" + msg
+        """show the step the current sample is running"""
+        with self._lock:
+            row = self._current()
+            if row:
+                row.step(msg)
         try:
-            status.update(name + msg)
             yield
         finally:
-            status.update(name)
+            if row:
+                row.step()
+
+    @contextmanager
+    def progress(
+        self,
+        description: str,
+        total: Optional[float] = None,
+        unit: str = "",
+        watch: Optional[Path] = None,
+    ) -> Generator[Callable[..., None], None, None]:
+        """show the progress of the current step in its sample's row
+
+        The yielded callable only records the progress,
+        it's rendered at most `REFRESH_PER_SECOND` times a second.
+        Outside of `cash_in` a row is shown for the description alone.
+
+        Args:
+            description: Task description.
+            total: Total amount of work, None for indeterminate.
+            unit: Unit of work, "B" for bytes.
+            watch: File whose size is used as the completed amount.
+        Yields:
+            Callable used to advance/update the task.
+        """
+        with ExitStack() as stack:
+            with self._lock:
+                row = self._current()
+            if not row:
+                row = stack.enter_context(self.cash_in(description))
+            row.reset(description, total, unit, watch)
+            try:
+                yield row.update
+            finally:
+                row.reset()
 
 
 cols = shutil.get_terminal_size().columns
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 import multiprocessing
-from typing import Dict, List
+from typing import Dict, List, Sequence
 
 import click
 from click.core import ParameterSource
@@ -9,6 +9,7 @@ from rich import box
 from rich.table import Table
 from rich.tree import Tree
 
+from .metrics import format_bytes, peak_rss
 from .options import PycashierOpts
 from .sample import ExtractSample, MergeSample, Sample, ScrnaSample
 from .term import term
@@ -154,3 +155,42 @@ def print_params(ctx: click.Context) -> None:
             term.print(
                 f"[dim]Only using {params['threads']} of {SYS_THREADS} available threads..."
             )
+
+
+def show_usage(samples: Sequence[Sample]) -> None:
+    """print wall time, cpu time and peak memory of each step
+
+    Peak memory of a step is that of its subprocesses,
+    pycashier's own peak is shown once below the table.
+    """
+    table = Table(
+        box=box.SIMPLE,
+        header_style="bold cyan",
+        collapse_padding=True,
+        caption=f"peak rss of pycashier: {format_bytes(peak_rss())}",
+    )
+    table.add_column("sample", style="green", no_wrap=True)
+    for column in ("step", "wall (s)", "cpu (s)", "peak rss"):
+        table.add_column(column, justify="right" if column != "step" else "left")
+
+    for sample in samples:
+        for i, usage in enumerate(sample.usage):
+            table.add_row(
+                sample.name if i == 0 else "",
+                usage.step,
+                f"{usage.wall:.1f}",
+                f"{usage.user + usage.sys:.1f}",
+                format_bytes(usage.max_rss) if usage.max_rss else "-",
+            )
+        if sample.usage:
+            peak = max(u.max_rss for u in sample.usage)
+            table.add_row(
+                "",
+                "[b]total",
+                f"[b]{sum(u.wall for u in sample.usage):.1f}",
+                f"[b]{sum(u.user + u.sys for u in sample.usage):.1f}",
+                f"[b]{format_bytes(peak)}" if peak else "-",
+            )
+        table.add_section()
+
+    term.print(table)
@@ -1,14 +1,13 @@
 from __future__ import annotations
 
+import io
 import shlex
 import subprocess
+import tempfile
 from pathlib import Path
-from typing import Dict, List
-
-import click
-import polars as pl
-from polars.exceptions import NoDataError
+from typing import IO, Callable, List, Optional
 
+from .metrics import wait_process
 from .term import term
 
 
@@ -44,31 +43,72 @@ def filter_input_by_sample(
 
 
 def fastq_to_tsv(in_file: Path, out_file: Path) -> bool | None:
-    """convert fastq file to tsv
+    """collapse barcode fastq into a tsv of unique barcodes and their counts
+
+    The output is headerless and sorted by count so it
+    can be passed directly to starcode.
 
     Args:
-        in_file: Fastq file to convert.
+        in_file: Fastq file to convert, may be gzipped.
         out_file: TSV file to write to.
     """
+    from .fastq import open_fastq
+
+    with open_fastq(in_file) as reads:
+        return count_barcodes(reads, out_file)
+
+
+def is_count_table(file: Path) -> bool:
+    """check that barcodes tsv is a count table and not a per-read table
+
+    Args:
+        file: Barcodes tsv from a current or previous run.
+    """
+    with file.open() as f:
+        return f.readline().rstrip("\n") != "info\tbarcode"
+
 
+def count_barcodes(reads: IO[bytes] | IO[str], out_file: Path) -> bool | None:
+    """collapse a stream of barcode reads into a table of counts
+
+    The output is a headerless tsv of sequence and count
+    sorted by count, which starcode accepts as input.
+
+    Args:
+        reads: Fastq formatted stream of extracted barcodes, binary or text.
+        out_file: TSV file to write counts to.
+    """
+    # polars is imported on use to keep the cli's startup fast
+    from .extract import BarcodeCounts
+    from .fastq import FastqError, read_fastq
+
+    if not isinstance(reads, io.TextIOBase):
+        reads = io.TextIOWrapper(reads)  # type: ignore
+
+    barcodes = BarcodeCounts()
     try:
-        pl.scan_csv(in_file, has_header=False, separator="\t").select(
-            pl.all().gather_every(4).alias("info"),
-            pl.all().gather_every(4, offset=1).alias("barcode"),
-        ).collect().write_csv(out_file, separator="\t")
-    except pl.ComputeError:
+        with term.progress("counting", unit="reads") as update:
+            for batch in read_fastq(reads, fields=("seq",)):
+                update(advance=batch.height)
+                barcodes.add(batch.get_column("seq"))
+    except FastqError as e:
         term.log.error(
-            f"failed to convert fastq to tsv: {in_file}\n"
+            f"failed to count barcodes for: {out_file}\n{e}, "
             "ensure fastq was not corrupted and contains all reads"
         )
         return True
-    except NoDataError:
+
+    if (counts := barcodes.collect()) is None:
         term.log.error(
-            f"failed to convert fastq to tsv: {in_file}\n"
+            f"failed to count barcodes for: {out_file}\n"
             "no reads found, check cutadapt output"
         )
         return True
 
+    counts.sort(["count", "barcode"], descending=[True, False]).write_csv(
+        out_file, separator="\t", include_header=False
+    )
+
 
 def extract_csv_column(csv_file: Path, out_file: Path) -> None:
     """get column from csv file
@@ -77,23 +117,24 @@ def extract_csv_column(csv_file: Path, out_file: Path) -> None:
         csv_file: File to extract column from.
         out_file: File to write column to.
     """
+    import polars as pl
+
     pl.scan_csv(csv_file, separator="\t").select(pl.col("barcode")).collect().write_csv(
         out_file, separator="\t", include_header=False
     )
 
 
-def get_filter_count(file_in: Path, filter_percent: float, quit: bool = False) -> int:
-    """calculate filter cutoff
+def clustered_total(file_in: Path) -> int:
+    """total number of reads in clustered lineage counts
 
     Args:
-        file_in: Clustered lineage counts to filter.
-        filter_percent: Percent cutoff of total reads count.
-        quit: exit if failure to get filter cutoff
-    Returns:
-        Minimum nominal cutoff value.
+        file_in: Clustered lineage counts.
     """
+    import polars as pl
+    from polars.exceptions import NoDataError
+
     try:
-        sum = (
+        total: int = (
             pl.scan_csv(
                 file_in,
                 separator="\t",
@@ -104,47 +145,46 @@ def get_filter_count(file_in: Path, filter_percent: float, quit: bool = False) -
             .collect(streaming=True)
             .item()
         )
+        return total
     except NoDataError:
         term.log.error(
             f"Failed to determine filter cutoff for empty file {file_in}.\n"
             " Please remove it and try again."
         )
         term.quit()
-    return int(
-        round(
-            sum * filter_percent / 100,
-            0,
-        )
-    )
 
 
-def validate_filter_args(ctx: click.Context) -> Dict[str, float]:
-    """validate filter argument from config and CLI
+def get_filter_count(
+    file_in: Path,
+    filter_percent: float,
+    quit: bool = False,
+    total: Optional[int] = None,
+) -> int:
+    """calculate filter cutoff
 
     Args:
-        ctx: Click context.
+        file_in: Clustered lineage counts to filter.
+        filter_percent: Percent cutoff of total reads count.
+        quit: exit if failure to get filter cutoff
+        total: Total reads in `file_in` if already known.
     Returns:
-        Dictionary defining the filter type and value.
+        Minimum nominal cutoff value.
     """
-    if ctx.params["filter_count"] or ctx.params["filter_count"] == 0:
-        if ctx.get_parameter_source("filter_percent").value == 3:  # type: ignore
-            ctx.params["filter_percent"] = None
-            del ctx.params["filter_percent"]
-            return {"filter_count": ctx.params["filter_count"]}
-        else:
-            raise click.BadParameter(
-                "`--filter-count` and `--filter-percent` are mutually exclusive"
-            )
-    else:
-        del ctx.params["filter_count"]
-        return {"filter_percent": ctx.params["filter_percent"]}
+    if total is None:
+        total = clustered_total(file_in)
+    return int(
+        round(
+            total * filter_percent / 100,
+            0,
+        )
+    )
 
 
-def exit_status(p: subprocess.CompletedProcess, file: Path) -> bool:
+def exit_status(p: subprocess.Popen, file: Path) -> bool:
     """check command exit status and file size
 
     Args:
-        p: Completed subprocess
+        p: Finished subprocess
         file: File to check for nonzero size.
     Returns:
         True for success, False otherwise.
@@ -152,6 +192,14 @@ def exit_status(p: subprocess.CompletedProcess, file: Path) -> bool:
     return True if p.returncode != 0 or file.stat().st_size == 0 else False
 
 
+def parse_percent(line: str) -> float:
+    """percentage from a progress line such as starcode's 'progress: 42.50%'"""
+    try:
+        return float(line.split(":", 1)[1].strip().rstrip("%"))
+    except (IndexError, ValueError):
+        return 0.0
+
+
 def run_cmd(
     command: str,
     sample: str,
@@ -169,21 +217,29 @@ def run_cmd(
         exit code
     """
     cmd_name = command.split()[0]
-    p = subprocess.run(
+    p = subprocess.Popen(
         shlex.split(command),
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
         universal_newlines=True,
     )
-
-    # remove 'progress: ##%' output from starcode
-    stdout = (
-        p.stdout
-        if not cmd_name == "starcode"
-        else "\n".join(
-            [line for line in p.stdout.splitlines() if not line.startswith("progress")]
-        )
-    )
+    assert p.stdout is not None
+    lines = []
+    # starcode reports its progress itself, other commands by their output's growth
+    if Path(cmd_name).name == "starcode":
+        progress = term.progress(cmd_name, total=100, unit="%")
+    else:
+        progress = term.progress(cmd_name, unit="B", watch=output)
+    with progress as update, p.stdout:
+        for line in p.stdout:
+            # remove 'progress: ##%' output from starcode
+            if line.startswith("progress:"):
+                update(completed=parse_percent(line))
+            else:
+                lines.append(line)
+    # records the cpu time and peak memory of the subcommand
+    wait_process(p)
+    stdout = "".join(lines)
 
     term.log.debug("subcommand:\n  [b]" + command)
     term.log.debug(
@@ -198,6 +254,76 @@ def run_cmd(
         return True
 
 
+def run_pipe(
+    commands: List[str],
+    sample: str,
+    consumer: Callable[[IO[bytes]], bool | None],
+) -> bool | None:
+    """run subcommands connected by pipes
+
+    The stdout of each command is piped to the next and the
+    stdout of the last command is passed to `consumer`.
+
+    Args:
+        commands: Subcommands to be chained together.
+        sample: Name of sample.
+        consumer: Function reading the final output stream.
+    Returns:
+        True if any command or the consumer failed.
+    """
+    procs: List[subprocess.Popen] = []
+    logs: List[IO[bytes]] = []
+    stdin: IO[bytes] | None = None
+    try:
+        for command in commands:
+            logs.append(tempfile.TemporaryFile())
+            p = subprocess.Popen(
+                shlex.split(command),
+                stdin=stdin,
+                stdout=subprocess.PIPE,
+                stderr=logs[-1],
+            )
+            # close our copy so upstream commands see a broken pipe on failure
+            if stdin:
+                stdin.close()
+            stdin = p.stdout
+            procs.append(p)
+
+        assert stdin is not None
+        with stdin:
+            failed = consumer(stdin)
+    except BaseException:
+        # don't leave commands running or blocked on a pipe nobody reads
+        for p in procs:
+            p.kill()
+            wait_process(p)
+            if p.stdout:
+                p.stdout.close()
+        for log in logs:
+            log.close()
+        raise
+
+    for command, p, log in zip(commands, procs, logs):
+        wait_process(p)
+        log.seek(0)
+        stdout = log.read().decode(errors="replace")
+        log.close()
+        cmd_name = command.split()[0]
+        term.log.debug("subcommand:\n  [b]" + command)
+        term.log.debug(
+            "subcommand output:\n"
+            + "\n".join(("[b]| [/]" + line for line in stdout.splitlines()))
+        )
+        if p.returncode != 0:
+            term.print(
+                f"[{Path(cmd_name).name.capitalize()}Error]: Subprocess for sample failed: [green]{sample}[/green]",
+                err=True,
+            )
+            failed = True
+
+    return failed
+
+
 def check_output(file: Path, message: str) -> bool:
     """check for output file and print message
 
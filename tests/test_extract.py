@@ -0,0 +1,88 @@
+from typing import Optional, Tuple
+
+import polars as pl
+import pytest
+from pycashier.extract import reconcile_mates
+
+# a read with its barcode after a short prefix
+SEQ1, SEQ2 = "TTACGTACGTTT", "TTTGCATGCATT"
+BARCODE1, BARCODE2 = "ACGTACGT", "TGCATGCA"
+HIGH, LOW = "I", "#"
+
+Mate = Tuple[str, str, Optional[str]]
+
+
+def quality(low: int, start: int = 2, length: int = 8) -> str:
+    """quality string of a read with `low` low quality bases within its barcode"""
+    barcode = LOW * low + HIGH * (length - low)
+    return HIGH * start + barcode + HIGH * (12 - start - length)
+
+
+def reconcile(mate1: Mate, mate2: Mate) -> Tuple[Optional[str], str]:
+    mates = pl.DataFrame(
+        {
+            "seq1": [mate1[0]],
+            "qual1": [mate1[1]],
+            "barcode1": [mate1[2]],
+            "seq2": [mate2[0]],
+            "qual2": [mate2[1]],
+            "barcode2": [mate2[2]],
+        },
+        schema={
+            name: pl.String
+            for name in ("seq1", "qual1", "barcode1", "seq2", "qual2", "barcode2")
+        },
+    )
+    called = reconcile_mates(mates)
+    return called.item(0, "barcode"), called.item(0, "call")
+
+
+@pytest.mark.parametrize(
+    ("mate1", "mate2", "expected"),
+    (
+        # mates agree, quality doesn't matter
+        (
+            (SEQ1, quality(8), BARCODE1),
+            (SEQ1, quality(0), BARCODE1),
+            (BARCODE1, "agreed"),
+        ),
+        # neither mate has a barcode
+        ((SEQ1, quality(0), None), (SEQ2, quality(0), None), (None, "none")),
+        # one mate is empty, even when the other is low quality
+        ((SEQ1, quality(8), BARCODE1), (SEQ2, quality(0), None), (BARCODE1, "single")),
+        ((SEQ1, quality(0), None), (SEQ2, quality(8), BARCODE2), (BARCODE2, "single")),
+        # mates disagree, the one with fewer low quality bases in its barcode wins
+        (
+            (SEQ1, quality(1), BARCODE1),
+            (SEQ2, quality(3), BARCODE2),
+            (BARCODE1, "quality"),
+        ),
+        (
+            (SEQ1, quality(3), BARCODE1),
+            (SEQ2, quality(1), BARCODE2),
+            (BARCODE2, "quality"),
+        ),
+        # quality ties are discarded
+        (
+            (SEQ1, quality(2), BARCODE1),
+            (SEQ2, quality(2), BARCODE2),
+            (None, "conflict"),
+        ),
+        (
+            (SEQ1, quality(0), BARCODE1),
+            (SEQ2, quality(0), BARCODE2),
+            (None, "conflict"),
+        ),
+    ),
+)
+def test_reconcile_mates(
+    mate1: Mate, mate2: Mate, expected: Tuple[Optional[str], str]
+) -> None:
+    assert reconcile(mate1, mate2) == expected
+
+
+def test_reconcile_mates_counts_quality_within_barcode() -> None:
+    # low quality bases outside the barcode aren't counted
+    outside = LOW * 2 + HIGH * 8 + LOW * 2
+    called = reconcile((SEQ1, outside, BARCODE1), (SEQ2, quality(1), BARCODE2))
+    assert called == (BARCODE1, "quality")
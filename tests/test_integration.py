@@ -1,9 +1,14 @@
+import json
+import shutil
+import subprocess
+import sys
 from pathlib import Path
 from typing import List
 
+import polars as pl
 import pytest
 from click import BaseCommand
-from pycashier.cli import checks, cli, extract, merge, receipt, scrna
+from pycashier.cli import checks, cli, extract, merge, receipt, scrna, status
 from utils import click_run, cmp_outs, purge
 
 TEST_DIR = Path(__file__).parent
@@ -14,11 +19,27 @@ OUTS_DIR, REF_DIR, MERGED_DIR, PIPELINE_DIR = (
 
 
 def test_help() -> None:
-    for cmd in cli, extract, merge, scrna, receipt:
+    for cmd in cli, extract, merge, scrna, receipt, status:
         result = click_run(cmd, ["--help"])
         assert result.exit_code == 0
 
 
+def test_startup_imports() -> None:
+    # heavy dependencies are only imported once a command runs
+    p = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, pycashier.cli; "
+            "print(*(m for m in ('polars', 'pysam', 'tomlkit') if m in sys.modules))",
+        ],
+        capture_output=True,
+        text=True,
+    )
+    assert p.returncode == 0
+    assert p.stdout.split() == []
+
+
 def test_pycashier_checks() -> None:
     result = click_run(
         checks,
@@ -47,6 +68,51 @@ def test_pycashier_checks() -> None:
             "test.q30.barcodes.r3d1.min0_off1.tsv",
             ["--filter-count", "0"],
         ),
+        (
+            extract,
+            REF_DIR / "rawfastqgzs",
+            PIPELINE_DIR / "pipe-extract-native",
+            REF_DIR / "outs",
+            OUTS_DIR,
+            "test.q30.barcodes.r3d1.min0_off1.tsv",
+            ["--extract-engine", "native"],
+        ),
+        (
+            extract,
+            REF_DIR / "rawfastqgzs",
+            PIPELINE_DIR / "pipe-extract-native-cluster",
+            REF_DIR / "outs",
+            OUTS_DIR,
+            "test.q30.barcodes.r3d1.min0_off1.tsv",
+            ["--cluster-engine", "native"],
+        ),
+        (
+            extract,
+            REF_DIR / "rawfastqgzs",
+            PIPELINE_DIR / "pipe-extract-compressed",
+            REF_DIR / "outs",
+            OUTS_DIR,
+            "test.q30.barcodes.r3d1.min0_off1.tsv",
+            ["--compress-intermediates"],
+        ),
+        (
+            extract,
+            REF_DIR / "rawfastqgzs",
+            PIPELINE_DIR / "pipe-extract-stream",
+            REF_DIR / "outs",
+            OUTS_DIR,
+            "test.q30.barcodes.r3d1.min0_off1.tsv",
+            ["--stream"],
+        ),
+        (
+            extract,
+            REF_DIR / "rawfastqgzs",
+            PIPELINE_DIR / "pipe-extract-stream-native",
+            REF_DIR / "outs",
+            OUTS_DIR,
+            "test.q30.barcodes.r3d1.min0_off1.tsv",
+            ["--stream", "--extract-engine", "native"],
+        ),
         # brocklab/pycashier#42
         (
             extract,
@@ -66,6 +132,45 @@ def test_pycashier_checks() -> None:
             "test.umi_cell_labeled.barcode.tsv",
             [],
         ),
+        # reads without an adapter seed are dropped before cutadapt, which finds the same barcodes
+        (
+            scrna,
+            REF_DIR / "sams",
+            PIPELINE_DIR / "pipe-scrna-prefilter",
+            REF_DIR / "outs-scrna",
+            OUTS_DIR,
+            "test.umi_cell_labeled.barcode.tsv",
+            ["--prefilter"],
+        ),
+        # reads from cells missing from the whitelist, or a raw barcode to correct
+        (
+            scrna,
+            REF_DIR / "sams-whitelist",
+            PIPELINE_DIR / "pipe-scrna-whitelist",
+            REF_DIR / "outs-scrna-whitelist",
+            OUTS_DIR,
+            "test.umi_cell_labeled.barcode.tsv",
+            ["--whitelist", REF_DIR / "whitelist.tsv"],
+        ),
+        # duplicate reads and UMIs, and a barcode with a sequencing error
+        (
+            scrna,
+            REF_DIR / "sams-umis",
+            PIPELINE_DIR / "pipe-scrna-umis",
+            REF_DIR / "outs-scrna-umis",
+            OUTS_DIR,
+            "test.cell_lineages.tsv",
+            [],
+        ),
+        (
+            scrna,
+            REF_DIR / "sams-umis",
+            PIPELINE_DIR / "pipe-scrna-umis-d1",
+            REF_DIR / "outs-scrna-umis",
+            OUTS_DIR,
+            "test.cell_lineages.d1.tsv",
+            ["--cell-distance", "1"],
+        ),
         (
             merge,
             REF_DIR / "unmergedfastqgzs",
@@ -99,16 +204,374 @@ def test_pycashier(
     assert cmp_outs(file_name, (ref_dir, outs_dir))
 
 
-def test_pycashier_receipt() -> None:
+def test_pycashier_manifest() -> None:
+    pipe_dir = PIPELINE_DIR / "pipe-manifest"
+    purge(OUTS_DIR, pipe_dir)
+    args = ["-i", REF_DIR / "rawfastqgzs", "-o", OUTS_DIR, "-p", pipe_dir, "-y"]
+    quality = pipe_dir / "test.q30.fastq"
+    barcode_fastq = pipe_dir / "test.q30.barcode.fastq"
+    manifest = pipe_dir / "manifest" / "test.json"
+
+    assert click_run(extract, args).exit_code == 0
+    quality_mtime = quality.stat().st_mtime_ns
+
+    # a changed error rate reruns extraction but not the quality filtering before it
+    result = click_run(extract, [*args, "--error", "0.2"])
+    print(result.output)
+    assert result.exit_code == 0
+    assert quality.stat().st_mtime_ns == quality_mtime
+    records = json.loads(manifest.read_text())
+    assert records["extract"]["fingerprint"]["params"]["error"] == 0.2
+
+    # a partial output left by an interrupted run is never taken as the output
+    barcode_fastq.rename(pipe_dir / f".partial.{barcode_fastq.name}")
+    (OUTS_DIR / "test.q30.barcodes.r3d1.min0_off1.tsv").unlink()
+    result = click_run(extract, args)
+    print(result.output)
+    assert result.exit_code == 0
+    assert not (pipe_dir / f".partial.{barcode_fastq.name}").exists()
+    assert cmp_outs(
+        "test.q30.barcodes.r3d1.min0_off1.tsv", (REF_DIR / "outs", OUTS_DIR)
+    )
+
+
+def test_pycashier_manifest_upstream() -> None:
+    pipe_dir = PIPELINE_DIR / "pipe-manifest-upstream"
+    purge(OUTS_DIR, pipe_dir)
+    args = ["-i", REF_DIR / "rawfastqgzs", "-o", OUTS_DIR, "-p", pipe_dir, "-y"]
+    outputs = [
+        pipe_dir / "test.q30.barcodes.tsv",
+        pipe_dir / "test.q30.barcodes.r3d1.tsv",
+        OUTS_DIR / "test.q30.barcodes.r3d1.min0_off1.tsv",
+    ]
+
+    result = click_run(extract, [*args, "--extract-engine", "native", "-e", "0.1"])
+    assert result.exit_code == 0
+    mtimes = [f.stat().st_mtime_ns for f in outputs]
+
+    # rerunning extraction regenerates everything downstream of it
+    result = click_run(extract, [*args, "-e", "0.3"])
+    print(result.output)
+    assert result.exit_code == 0
+    assert all(f.stat().st_mtime_ns != mtime for f, mtime in zip(outputs, mtimes))
+    records = json.loads((pipe_dir / "manifest" / "test.json").read_text())
+    assert {"extract", "count", "cluster"} <= records.keys()
+
+
+@pytest.mark.parametrize(
+    ("cmd", "input_file", "ref_dir", "suffix"),
+    (
+        (
+            extract,
+            REF_DIR / "rawfastqgzs" / "test.fastq.gz",
+            REF_DIR / "outs",
+            ".q30.barcodes.r3d1.min0_off1.tsv",
+        ),
+        (
+            scrna,
+            REF_DIR / "sams" / "test.sam",
+            REF_DIR / "outs-scrna",
+            ".umi_cell_labeled.barcode.tsv",
+        ),
+    ),
+)
+def test_pycashier_jobs(
+    cmd: BaseCommand, input_file: Path, ref_dir: Path, suffix: str
+) -> None:
+    input_dir = PIPELINE_DIR / f"inputs-jobs-{cmd.name}"
+    pipe_dir = PIPELINE_DIR / f"pipe-jobs-{cmd.name}"
+    purge(input_dir, pipe_dir, OUTS_DIR)
+    input_dir.mkdir(parents=True)
+    # several copies of the sample processed concurrently
+    samples = ("test", "copy1", "copy2")
+    for sample in samples:
+        shutil.copy(input_file, input_dir / input_file.name.replace("test", sample))
+
+    result = click_run(
+        cmd,
+        ["-i", input_dir, "-o", OUTS_DIR, "-p", pipe_dir, "-y", "-j", "2", "-t", "4"],
+    )
+
+    print(result.output)
+    assert result.exit_code == 0
+    reference = (ref_dir / f"test{suffix}").read_text()
+    for sample in samples:
+        assert (OUTS_DIR / f"{sample}{suffix}").read_text() == reference
+
+
+def test_pycashier_scrna_bam() -> None:
+    pysam = pytest.importorskip("pysam")
+    bam_dir, pipe_dir = PIPELINE_DIR / "bams", PIPELINE_DIR / "pipe-scrna-bam"
+    purge(bam_dir, pipe_dir, OUTS_DIR)
+    bam_dir.mkdir(parents=True)
+
+    # a sorted and indexed bam of the unmapped reads in the reference sam
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"}, "SQ": [{"SN": "chr1", "LN": 1}]}
+    sam = pysam.AlignmentFile(str(REF_DIR / "sams" / "test.sam"), "r", check_sq=False)
+    bam = pysam.AlignmentFile(str(bam_dir / "test.bam"), "wb", header=header)
+    with sam, bam:
+        for record in sam.fetch(until_eof=True):
+            bam.write(pysam.AlignedSegment.fromstring(record.to_string(), bam.header))
+    pysam.index(str(bam_dir / "test.bam"))
+
+    result = click_run(
+        scrna,
+        ["-i", bam_dir, "-o", OUTS_DIR, "-p", pipe_dir, "-y", "--unmapped-only"],
+    )
+
+    print(result.output)
+    assert result.exit_code == 0
+    assert cmp_outs(
+        "test.umi_cell_labeled.barcode.tsv", (REF_DIR / "outs-scrna", OUTS_DIR)
+    )
+
+
+def test_pycashier_scrna_chunks(monkeypatch: pytest.MonkeyPatch) -> None:
+    # split the sam into several chunks converted by worker processes
+    monkeypatch.setattr("pycashier.scrna.CHUNK_SIZE", 2**16)
+    monkeypatch.setattr("pycashier.scrna.PARALLEL_MIN_SIZE", 0)
+    pipe_dir = PIPELINE_DIR / "pipe-scrna-chunks"
+    purge(OUTS_DIR, pipe_dir)
+
+    result = click_run(
+        scrna,
+        ["-i", REF_DIR / "sams", "-o", OUTS_DIR, "-p", pipe_dir, "-y", "-t", "2"],
+    )
+
+    print(result.output)
+    assert result.exit_code == 0
+    assert cmp_outs(
+        "test.umi_cell_labeled.barcode.tsv", (REF_DIR / "outs-scrna", OUTS_DIR)
+    )
+
+
+def test_pycashier_scrna_missing_quality() -> None:
+    sam_dir, pipe_dir = (
+        PIPELINE_DIR / "sams-no-qual",
+        PIPELINE_DIR / "pipe-scrna-no-qual",
+    )
+    purge(sam_dir, pipe_dir, OUTS_DIR)
+    sam_dir.mkdir(parents=True)
+    with (
+        (REF_DIR / "sams" / "test.sam").open() as f_in,
+        (sam_dir / "test.sam").open("w") as f_out,
+    ):
+        for line in f_in:
+            fields = line.split("\t")
+            if not line.startswith("@"):
+                fields[10] = "*"
+            f_out.write("\t".join(fields))
+
+    result = click_run(scrna, ["-i", sam_dir, "-o", OUTS_DIR, "-p", pipe_dir, "-y"])
+
+    print(result.output)
+    assert result.exit_code == 0
+    assert cmp_outs(
+        "test.umi_cell_labeled.barcode.tsv", (REF_DIR / "outs-scrna", OUTS_DIR)
+    )
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_pycashier_scrna_malformed(
+    parallel: bool, monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture
+) -> None:
+    if parallel:
+        monkeypatch.setattr("pycashier.scrna.CHUNK_SIZE", 2**16)
+        monkeypatch.setattr("pycashier.scrna.PARALLEL_MIN_SIZE", 0)
+    sam_dir, pipe_dir = (
+        PIPELINE_DIR / "sams-malformed",
+        PIPELINE_DIR / "pipe-scrna-malformed",
+    )
+    purge(sam_dir, pipe_dir, OUTS_DIR)
+    sam_dir.mkdir(parents=True)
+    with (
+        (REF_DIR / "sams" / "test.sam").open() as f_in,
+        (sam_dir / "test.sam").open("w") as f_out,
+    ):
+        for line in f_in:
+            fields = line.split("\t")
+            if not line.startswith("@"):
+                fields[1] = "not-a-flag"
+            f_out.write("\t".join(fields))
+
+    result = click_run(
+        scrna,
+        ["-i", sam_dir, "-o", OUTS_DIR, "-p", pipe_dir, "-y", "-t", "2"]
+        + ["--unmapped-only"],
+    )
+
+    print(result.output)
+    assert "Is it the correct format?" in caplog.text
+    assert not (OUTS_DIR / "test.umi_cell_labeled.barcode.tsv").is_file()
+
+
+def test_pycashier_scrna_whitelist_rerun() -> None:
+    pipe_dir = PIPELINE_DIR / "pipe-scrna-whitelist-rerun"
+    purge(OUTS_DIR, pipe_dir)
+    args = ["-i", REF_DIR / "sams", "-o", OUTS_DIR, "-p", pipe_dir, "-y"]
+    barcodes = OUTS_DIR / "test.umi_cell_labeled.barcode.tsv"
+
+    assert click_run(scrna, args).exit_code == 0
+    assert pl.read_csv(barcodes, separator="\t").height == 5
+
+    # a whitelist added to a completed pipeline reconverts the sam
+    whitelist = pipe_dir / "barcodes.tsv"
+    whitelist.write_text("TGACCCTAGCATGGGT-1\nGATAGAAGTAGCTCGC-1\n")
+    result = click_run(scrna, [*args, "--whitelist", whitelist])
+
+    print(result.output)
+    assert result.exit_code == 0
+    assert pl.read_csv(barcodes, separator="\t").get_column(
+        "cell"
+    ).sort().to_list() == [
+        "GATAGAAGTAGCTCGC",
+        "TGACCCTAGCATGGGT",
+    ]
+
+
+def test_pycashier_scrna_prefilter_rerun() -> None:
+    pipe_dir = PIPELINE_DIR / "pipe-scrna-prefilter-rerun"
+    purge(OUTS_DIR, pipe_dir)
+    args = ["-i", REF_DIR / "sams", "-o", OUTS_DIR, "-p", pipe_dir, "-y"]
+    fastq = pipe_dir / "test.umi_cell_labeled.fastq"
+
+    assert click_run(scrna, args).exit_code == 0
+    unfiltered = fastq.stat().st_size
+
+    # enabling the prefilter on a completed pipeline reconverts the sam
+    result = click_run(scrna, [*args, "--prefilter"])
+
+    print(result.output)
+    assert result.exit_code == 0
+    assert fastq.stat().st_size < unfiltered
+    assert cmp_outs(
+        "test.umi_cell_labeled.barcode.tsv", (REF_DIR / "outs-scrna", OUTS_DIR)
+    )
+
+
+@pytest.mark.parametrize("mode", ("merge", "mates"))
+def test_pycashier_extract_paired(mode: str) -> None:
+    PIPELINE_DIR.mkdir(exist_ok=True, parents=True)
+    pipe_dir = PIPELINE_DIR / f"pipe-extract-paired-{mode}"
+    purge(OUTS_DIR, pipe_dir)
+
+    result = click_run(
+        extract,
+        ["-i", REF_DIR / "unmergedfastqgzs", "-o", OUTS_DIR, "-p", pipe_dir, "-y"]
+        + ["--paired", "--paired-mode", mode],
+    )
+
+    print(result.output)
+    assert result.exit_code == 0
+    # merged reads are streamed into extraction and never written
+    assert not list(pipe_dir.glob("*.fastq*"))
+    if mode == "mates":
+        assert (OUTS_DIR / "test.q30.barcodes.r3d1.min0_off1.tsv").is_file()
+        return
+
+    # merging in one fastp call gives the same barcodes as extracting merged reads
+    merged_outs, merged_pipe = OUTS_DIR / "merged", PIPELINE_DIR / "pipe-merged"
+    purge(merged_pipe)
+    result = click_run(
+        extract,
+        ["-i", REF_DIR / "mergedfastqs", "-o", merged_outs, "-p", merged_pipe, "-y"],
+    )
+
+    print(result.output)
+    assert result.exit_code == 0
+    assert cmp_outs("test.q30.barcodes.r3d1.min0_off1.tsv", (merged_outs, OUTS_DIR))
+
+
+def test_pycashier_claim(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr("pycashier.lease.LEASE_SECONDS", 1)
+    pipe_dir = PIPELINE_DIR / "pipe-claim"
+    purge(OUTS_DIR, pipe_dir)
+    args = ["-i", REF_DIR / "rawfastqgzs", "-o", OUTS_DIR, "-p", pipe_dir, "-y"]
+
+    # a worker which died while holding the sample, it's retried until the lease expires
+    lock = pipe_dir / "locks" / "extract" / "test.lock"
+    lock.parent.mkdir(parents=True)
+    lock.write_text(json.dumps({"owner": "node2:1", "token": "0"}))
+    result = click_run(extract, [*args, "--claim"])
+
+    print(result.output)
+    assert result.exit_code == 0
+    assert "1 samples are claimed by other workers" in result.output
+    assert "broke the lease on test held by node2:1" in result.output
+    assert (OUTS_DIR / "test.q30.barcodes.r3d1.min0_off1.tsv").is_file()
+    assert not lock.is_file()
+
+
+def test_pycashier_status() -> None:
+    pipe_dir = PIPELINE_DIR / "pipe-status"
+    purge(pipe_dir)
+    args = ["-i", REF_DIR / "rawfastqgzs", "-p", pipe_dir, "-o", REF_DIR / "outs"]
+
+    # second run reads the state index written by the first
+    for _ in range(2):
+        result = click_run(status, args)
+        print(result.output)
+        assert result.exit_code == 0
+        assert "There are 1 samples to finish processing" in result.output
+    assert (pipe_dir / "state" / "index.json").is_file()
+
+
+@pytest.mark.parametrize("sort", ("sample", "none"))
+def test_pycashier_receipt(sort: str) -> None:
     PIPELINE_DIR.mkdir(exist_ok=True, parents=True)
     outfile = TEST_DIR / "data/combined.tsv"
     purge(outfile, PIPELINE_DIR / "pipe-receipt")
 
     result = click_run(
         receipt,
-        ["-i", REF_DIR / "outs", "-p", PIPELINE_DIR / "pipe-receipt", "-o", outfile],
+        ["-i", REF_DIR / "outs", "-p", PIPELINE_DIR / "pipe-receipt", "-o", outfile]
+        + ["--sort", sort],
     )
 
     print(result.output)
     assert result.exit_code == 0
+    if sort == "sample":
+        assert cmp_outs("combined.tsv", (REF_DIR, TEST_DIR / "data"))
+    else:
+        # the same rows in no particular order
+        expected = pl.read_csv(REF_DIR / "combined.tsv", separator="\t")
+        combined = pl.read_csv(outfile, separator="\t")
+        assert combined.sort(pl.all()).equals(expected.sort(pl.all()))
+
+
+def test_pycashier_receipt_incremental() -> None:
+    PIPELINE_DIR.mkdir(exist_ok=True, parents=True)
+    outfile = TEST_DIR / "data/combined.tsv"
+    purge(outfile, PIPELINE_DIR / "pipe-receipt-incremental")
+
+    args = ["-i", REF_DIR / "outs", "-p", PIPELINE_DIR / "pipe-receipt-incremental"]
+    args += ["-o", outfile, "--incremental"]
+    # add the second sample to an existing receipt
+    for samples in ("test", "test,test2"):
+        result = click_run(receipt, args + ["-s", samples])
+        print(result.output)
+        assert result.exit_code == 0
+
     assert cmp_outs("combined.tsv", (REF_DIR, TEST_DIR / "data"))
+
+
+@pytest.mark.parametrize(("fmt", "suffix"), (("parquet", "parquet"), ("ipc", "arrow")))
+def test_pycashier_receipt_format(fmt: str, suffix: str) -> None:
+    PIPELINE_DIR.mkdir(exist_ok=True, parents=True)
+    outfile = TEST_DIR / f"data/combined.{suffix}"
+    purge(outfile, PIPELINE_DIR / "pipe-receipt")
+
+    result = click_run(
+        receipt,
+        ["-i", REF_DIR / "outs", "-p", PIPELINE_DIR / "pipe-receipt", "-o", outfile]
+        + ["--format", fmt],
+    )
+
+    print(result.output)
+    assert result.exit_code == 0
+    df = pl.read_parquet(outfile) if fmt == "parquet" else pl.read_ipc(outfile)
+    assert df.schema["count"] == pl.Int64
+    assert isinstance(df.schema["sample"], pl.Enum)
+    assert df.with_columns(pl.col("sample").cast(pl.String)).equals(
+        pl.read_csv(REF_DIR / "combined.tsv", separator="\t")
+    )